@@ -0,0 +1,281 @@
+''' Benchmarks for the dashboard callbacks and data paths
+
+Synthetic flights of each requested size are written to a scratch
+directory, the Air4Thai API is replaced by a local stub server and MySQL is
+not touched. Each callback is driven through Dash's own
+/_dash-update-component route, so the numbers include JSON serialization:
+
+    cold     first call on a fresh cache (parse, ingest, fetch)
+    warm     median of the following --repeat calls
+    peak     peak traced Python memory of the cold call
+    payload  response size in bytes, gzip-compressed
+
+Usage:
+    python benchmarks/bench_dashboard.py --sizes 1e3 1e4 1e5 1e6 --save baseline.json
+    python benchmarks/bench_dashboard.py --compare baseline.json
+'''
+import argparse
+import base64
+import gzip
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+DASHBOARD = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dashboard')
+
+# output id fragments of the callbacks to measure
+CALLBACKS = {
+    'update_map': 'map-graph.figure',
+    'update_overview': 'overview-figure.data',
+    'update_metadata': 'meta-name.children',
+    'update_tinv': 'tinv-figure.data',
+    'update_prediction': 'tinv-prediction.children',
+}
+
+# background callbacks: the output of the start callback and of the poll callback
+BACKGROUND = {
+    'update_compare': ('compare-job.data', 'compare-graph.figure'),
+    'update_pm': ('pm-job.data', 'pm-figure.data'),
+}
+
+
+def synthetic_flight(n, seed=0):
+    ''' Return a flight of n samples: one ascent and descent through an inversion at 60 m '''
+    rng = np.random.RandomState(seed)
+    t = np.linspace(0, 1, n)
+    alt = 5 + 95 * np.sin(np.pi * t) + rng.normal(0, 0.3, n)
+    temp = 33 - 0.0098 * alt + 1.5 * np.clip((alt - 55) / 10, 0, 1) + rng.normal(0, 0.05, n)
+    press = 1009 - alt / 8.3
+    start = pd.Timestamp('2019-05-13 11:00:00')
+    # a 4 Hz logger, like the real balloon
+    stamps = start + pd.to_timedelta(np.arange(n) * 250, unit='ms')
+    return pd.DataFrame({'datetime': stamps, 'temp': temp.round(2),
+                         'press': press.round(1), 'alt': alt.round(2)})
+
+
+def synthetic_log(path, n, seed=0):
+    ''' Write a MAVLink-style log with n scaled pressure lines among attitude lines '''
+    rng = np.random.RandomState(seed)
+    start = pd.Timestamp('2019-05-13 11:00:00')
+    with open(path, 'w') as f:
+        for i in range(n):
+            stamp = (start + pd.Timedelta(milliseconds=100 * i)).strftime('%Y-%m-%d %H:%M:%S.%f')
+            fields = [str(stamp), 'mavlink_scaled_pressure_t', 'time_boot_ms', str(i)]
+            fields += ['x'] * 9
+            fields += ['{:.2f}'.format(1000 + rng.rand()), 'press_diff', '{:.3f}'.format(rng.rand()),
+                       'temperature', str(3000 + i % 100), '0', '0', '0', '0']
+            f.write(','.join(fields) + '\n')
+            f.write('{},mavlink_attitude_t,roll,0.1,pitch,0.2,yaw,0.3\n'.format(stamp))
+
+
+class StubAir4Thai(BaseHTTPRequestHandler):
+    ''' Answers data.php with an hourly series covering the requested days '''
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        sdate = pd.Timestamp('20' + query['sdate'][0])
+        edate = pd.Timestamp('20' + query['edate'][0])
+        hours = pd.date_range(sdate, edate + pd.Timedelta(hours=23), freq='60min')
+        data = [{'DATETIMEDATA': str(h), query['param'][0]: 20 + (i % 24)}
+                for i, h in enumerate(hours)]
+        body = json.dumps({'stations': [{'stationID': query['stationID'][0], 'data': data}]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_stub():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubAir4Thai)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def measure(fn, repeat):
+    ''' Return (cold seconds, warm median seconds, cold peak bytes, result) '''
+    tracemalloc.start()
+    t = time.perf_counter()
+    result = fn()
+    cold = time.perf_counter() - t
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    warm = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        warm.append(time.perf_counter() - t)
+    return cold, statistics.median(warm) if warm else None, peak, result
+
+
+def unzip(data):
+    # Flask-Compress leaves small responses alone
+    return gzip.decompress(data) if data[:2] == b'\x1f\x8b' else data
+
+
+class DashClient(object):
+    ''' Calls callbacks the way the browser does '''
+
+    def __init__(self, app, users):
+        self.app = app
+        self.client = app.server.test_client()
+        user, password = users[0]
+        token = base64.b64encode('{}:{}'.format(user, password).encode()).decode()
+        # payload sizes are measured as sent to a browser, compressed
+        self.headers = {'Authorization': 'Basic ' + token, 'Accept-Encoding': 'gzip'}
+
+    def call(self, fragment, values):
+        output = next(key for key in self.app.callback_map if fragment in key)
+        spec = self.app.callback_map[output]
+        inputs = [dict(i, value=values.get(i['id'])) for i in spec['inputs']]
+        state = [dict(s, value=values.get(s['id'])) for s in spec['state']]
+        body = {'output': output, 'inputs': inputs, 'state': state,
+                'changedPropIds': ['{}.{}'.format(i['id'], i['property']) for i in spec['inputs'][:1]]}
+        r = self.client.post('/_dash-update-component', data=json.dumps(body),
+                             content_type='application/json', headers=self.headers)
+        if r.status_code not in (200, 204):
+            raise RuntimeError('{} returned {}'.format(output, r.status_code))
+        return r.get_data()
+
+    def run_job(self, start, poll, values):
+        ''' Start a background callback and poll it until its result arrives '''
+        body = json.loads(unzip(self.call(start, values)))
+        polled = dict(values, **{start.split('.')[0]: body['response']['props']['data']})
+        while True:
+            data = self.call(poll, polled)
+            if poll.split('.')[0].encode() in unzip(data):
+                return data
+            time.sleep(0.005)
+
+
+def run(sizes, repeat, scratch):
+    balloon = os.path.join(scratch, 'balloon')
+    os.makedirs(balloon)
+    names = {}
+    for n in sizes:
+        names[n] = 'synthetic_{}.csv'.format(n)
+        synthetic_flight(n).to_csv(os.path.join(balloon, names[n]), index=False)
+
+    stub = start_stub()
+    os.environ['AIR4THAI_URL'] = 'http://127.0.0.1:{}/data.php'.format(stub.server_port)
+
+    # point every data path at the scratch directory before the app is imported
+    os.chdir(DASHBOARD)
+    sys.path.insert(0, DASHBOARD)
+    import air4thai
+    import catalog
+    import flightcache
+    import flightstore
+    import jobs
+    import mavlink
+    import warehouse
+    flightcache.pathway = balloon + os.sep
+    flightstore.storeway = os.path.join(scratch, 'store')
+    catalog.catalogway = os.path.join(scratch, 'catalog.json')
+    air4thai.cache.path = os.path.join(scratch, 'air4thai')
+    jobs.jobway = os.path.join(scratch, 'jobs.sqlite')
+    warehouse.warehouseway = os.path.join(scratch, 'warehouse') + os.sep
+    # no background sync against the stub while callbacks are timed
+    warehouse.SYNC_INTERVAL = None
+    import app as dashboard
+
+    client = DashClient(dashboard.app, dashboard.VALID_USERNAME_PASSWORD_PAIRS)
+
+    results = []
+    for n in sizes:
+        flightcache.flight_cache.invalidate()
+        values = {'filename': names[n], 'compare': [names[n]], 'pm': 'PM25',
+                  'map-hour': 12, 'live': []}
+        for name, fragment in sorted(CALLBACKS.items()):
+            cold, warm, peak, payload = measure(lambda: client.call(fragment, values), repeat)
+            results.append({'case': name, 'size': n, 'cold': cold, 'warm': warm,
+                            'peak': peak, 'payload': len(payload)})
+        for name, (start, poll) in sorted(BACKGROUND.items()):
+            cold, warm, peak, payload = measure(
+                lambda: client.run_job(start, poll, values), repeat)
+            results.append({'case': name, 'size': n, 'cold': cold, 'warm': warm,
+                            'peak': peak, 'payload': len(payload)})
+
+        log = os.path.join(scratch, 'log_{}.txt'.format(n))
+        synthetic_log(log, n)
+        cold, warm, peak, df = measure(
+            lambda: mavlink.load_message(log, 'mavlink_scaled_pressure_t'), repeat)
+        results.append({'case': 'mavlink_scaled_pressure', 'size': n, 'cold': cold,
+                        'warm': warm, 'peak': peak, 'payload': int(df.memory_usage().sum())})
+
+    stub.shutdown()
+    return results
+
+
+def report(results, baseline=None, tolerance=0.2):
+    ''' Print the results, with ratios against a baseline, and return the regressions '''
+    base = {(r['case'], r['size']): r for r in baseline or []}
+    regressions = []
+    print('{:<26}{:>10}{:>12}{:>12}{:>12}{:>12}{:>10}'.format(
+        'case', 'size', 'cold ms', 'warm ms', 'peak MB', 'payload kB', 'vs base'))
+    for r in results:
+        ratio = ''
+        old = base.get((r['case'], r['size']))
+        if old and old['warm'] and r['warm']:
+            ratio = r['warm'] / old['warm']
+            if ratio > 1 + tolerance:
+                regressions.append(r)
+            ratio = '{:.2f}x'.format(ratio)
+        print('{:<26}{:>10}{:>12.1f}{:>12}{:>12.1f}{:>12.1f}{:>10}'.format(
+            r['case'], r['size'], r['cold'] * 1e3,
+            '-' if r['warm'] is None else '{:.1f}'.format(r['warm'] * 1e3),
+            r['peak'] / 2 ** 20, r['payload'] / 1024, ratio))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the dashboard callbacks')
+    parser.add_argument('--sizes', nargs='+', type=float, default=[1e3, 1e4, 1e5, 1e6],
+                        help='flight sizes in samples, up to 1e7')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare warm latency against this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown ratio above which a case counts as a regression')
+    args = parser.parse_args()
+
+    # run() changes into the dashboard directory
+    if args.save:
+        args.save = os.path.abspath(args.save)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    scratch = tempfile.mkdtemp(prefix='pollucell-bench-')
+    try:
+        results = run([int(n) for n in args.sizes], args.repeat, scratch)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    regressions = report(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,184 @@
+''' Cached client for the Air4Thai hourly history API
+
+Responses are kept on disk keyed by station, param, date range and type.
+A response whose range ends before today (Bangkok time) never changes and is
+kept forever; one that covers today expires after TODAY_TTL seconds.
+
+prefetch() fetches several params concurrently on a small thread pool and
+keeps the resulting frames in memory, so switching between them is free.
+Frames covering today are fetched again once they are TODAY_TTL seconds old,
+like their responses on disk.
+
+Set AIR4THAI_URL to point the client at another server, e.g. a local stub.
+'''
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import phase
+
+url = os.environ.get('AIR4THAI_URL', 'http://air4thai.pcd.go.th/webV2/history/api/data.php')
+cacheway = '../cache/air4thai/'
+
+PARAMS = ['PM25', 'PM10', 'NO2']
+
+TODAY_TTL = 5 * 60
+TIMEOUT = 10
+DATE_FORMAT = '%y-%m-%d'
+BANGKOK = timedelta(hours=7)
+MAX_WORKERS = 4
+MAX_SERIES = 64
+
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=2))
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=2))
+
+
+def today():
+    return (datetime.utcnow() + BANGKOK).date()
+
+
+def fresh(edate, fetched, today_ttl=TODAY_TTL):
+    ''' Whether data for a range ending on edate, fetched at time fetched, is still current '''
+    edate = datetime.strptime(edate, DATE_FORMAT).date()
+    return edate < today() or time.time() - fetched < today_ttl
+
+
+class HistoryCache(object):
+    ''' On-disk cache of API responses, one JSON file per request '''
+
+    def __init__(self, path=cacheway, today_ttl=TODAY_TTL):
+        self.path = path
+        self.today_ttl = today_ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _file(self, params):
+        key = '&'.join('{}={}'.format(k, params[k]) for k in sorted(params))
+        return os.path.join(self.path, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    def _fresh(self, params, fetched):
+        return fresh(params['edate'], fetched, self.today_ttl)
+
+    def get(self, params):
+        try:
+            with open(self._file(params)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            entry = None
+        if entry is not None and self._fresh(params, entry['fetched']):
+            with self._lock:
+                self.hits += 1
+            return entry['source']
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, params, source):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        path = self._file(params)
+        tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump({'fetched': time.time(), 'params': params, 'source': source}, f)
+        os.replace(tmp, path)
+
+
+cache = HistoryCache()
+
+
+def history_params(station_id, param, sdate, edate, stime='00', etime='24', type='hr'):
+    return {
+        'stationID': station_id,
+        'param': param,
+        'type': type,
+        'sdate': sdate,
+        'edate': edate,
+        'stime': stime,
+        'etime': etime,
+    }
+
+
+def request_history(params):
+    ''' Return the decoded API response, always asking the server '''
+    r = session.get(url, params=params, timeout=TIMEOUT)
+    r.raise_for_status()
+    return r.json()
+
+
+def get_history(station_id, param, sdate, edate, stime='00', etime='24', type='hr'):
+    ''' Return the decoded API response, from the cache when possible '''
+    params = history_params(station_id, param, sdate, edate, stime, etime, type)
+    source = cache.get(params)
+    if source is None:
+        source = request_history(params)
+        cache.put(params, source)
+    return source
+
+
+def _load_history(station_id, param, sdate, edate, stime, etime, type):
+    source = get_history(station_id, param, sdate, edate, stime, etime, type)
+    df = pd.DataFrame(source['stations'][0]['data'])
+    df.columns = ['datetime', 'value']
+    return df
+
+
+_series = OrderedDict()
+_series_lock = threading.RLock()
+_executor = None
+_executor_pid = None
+
+
+def _get_executor():
+    # a pool inherited across fork has no threads behind it, so build one per process
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        _executor_pid = os.getpid()
+    return _executor
+
+
+def _forget(key, future):
+    if future.exception() is not None:
+        with _series_lock:
+            if key in _series and _series[key][0] is future:
+                del _series[key]
+
+
+def prefetch(station_id, params, sdate, edate, stime='00', etime='24', type='hr'):
+    ''' Start fetching every param concurrently and return {param: Future} '''
+    futures = {}
+    with _series_lock:
+        for param in params:
+            key = (station_id, param, sdate, edate, stime, etime, type)
+            future, started = _series.get(key, (None, None))
+            if future is None or not fresh(edate, started):
+                future = _get_executor().submit(_load_history, *key)
+                future.add_done_callback(lambda f, key=key: _forget(key, f))
+                _series[key] = (future, time.time())
+            _series.move_to_end(key)
+            futures[param] = future
+        while len(_series) > MAX_SERIES:
+            _series.popitem(last=False)
+    return futures
+
+
+def fetch_history(station_id, param, sdate, edate, stime='00', etime='24', type='hr'):
+    ''' Return a station's history as a DataFrame with datetime and value columns
+
+    The other PARAMS for the same window are prefetched alongside it.
+    '''
+    params = [param] + [p for p in PARAMS if p != param]
+    futures = prefetch(station_id, params, sdate, edate, stime, etime, type)
+    with phase('load'):
+        return futures[param].result()
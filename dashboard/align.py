@@ -0,0 +1,106 @@
+''' Attach station observations to balloon samples by time
+
+Observation times are sorted once and every sample is located with a single
+searchsorted, like pd.merge_asof. Station values can be a (series, times)
+matrix - several stations or params on a shared hourly axis - and samples
+can be the concatenated samples of many flights, so a whole batch is aligned
+in one vectorized pass.
+
+Methods:
+    backward  last observation at or before the sample (merge_asof default)
+    forward   first observation at or after the sample
+    nearest   closest observation in time
+    linear    linear interpolation between the two surrounding observations
+'''
+import numpy as np
+import pandas as pd
+
+
+def _as_ns(times):
+    return np.asarray(pd.to_datetime(times)).astype('datetime64[ns]').view('int64')
+
+
+def align(sample_times, obs_times, obs_values, method='nearest', tolerance=None):
+    ''' Return obs_values sampled at sample_times, NaN where no observation qualifies
+
+    obs_values is 1-D (times,) or 2-D (series, times); the result has shape
+    (samples,) or (series, samples). tolerance is a Timedelta limiting how far
+    the chosen observation may be from the sample.
+    '''
+    t = _as_ns(sample_times)
+    obs = _as_ns(obs_times)
+    values = np.asarray(obs_values, dtype='float64')
+    squeeze = values.ndim == 1
+    values = np.atleast_2d(values)
+
+    order = np.argsort(obs, kind='mergesort')
+    obs = obs[order]
+    values = values[:, order]
+    n = len(obs)
+    out = np.full((values.shape[0], len(t)), np.nan)
+    if n == 0:
+        return out[0] if squeeze else out
+
+    right = np.searchsorted(obs, t, side='left')
+    exact = (right < n) & (obs[np.minimum(right, n - 1)] == t)
+    left = np.where(exact, right, right - 1)
+    has_left = left >= 0
+    has_right = right < n
+    li = np.clip(left, 0, n - 1)
+    ri = np.clip(right, 0, n - 1)
+
+    if method == 'linear':
+        span = (obs[ri] - obs[li]).astype('float64')
+        with np.errstate(divide='ignore', invalid='ignore'):
+            w = np.where(span > 0, (t - obs[li]) / span, 0.0)
+        out = values[:, li] * (1 - w) + values[:, ri] * w
+        valid = has_left & has_right
+        pick_dist = np.maximum(t - obs[li], obs[ri] - t)
+    else:
+        if method == 'backward':
+            pick, valid = li, has_left
+        elif method == 'forward':
+            pick, valid = ri, has_right
+        elif method == 'nearest':
+            closer_right = has_right & (~has_left | (obs[ri] - t < t - obs[li]))
+            pick = np.where(closer_right, ri, li)
+            valid = has_left | has_right
+        else:
+            raise ValueError('unknown method {!r}'.format(method))
+        out = values[:, pick]
+        pick_dist = np.abs(t - obs[pick])
+
+    if tolerance is not None:
+        valid = valid & (pick_dist <= pd.Timedelta(tolerance).value)
+    out[:, ~valid] = np.nan
+    return out[0] if squeeze else out
+
+
+def station_matrix(series):
+    ''' Stack {name: DataFrame(datetime, value)} onto one time axis
+
+    Returns (times, names, values) with values shaped (len(names), len(times)).
+    '''
+    names = sorted(series)
+    frame = pd.concat(
+        [series[name].assign(datetime=pd.to_datetime(series[name]['datetime']))
+                     .set_index('datetime')['value'].astype('float64').rename(name)
+         for name in names], axis=1)
+    frame = frame[~frame.index.duplicated()].sort_index()
+    return frame.index.values, names, frame.values.T
+
+
+def align_flights(flights, series, method='linear', tolerance=pd.Timedelta(hours=2)):
+    ''' Attach every station series to every flight sample in one pass
+
+    flights is {name: flight DataFrame} and series is {name: DataFrame(datetime,
+    value)}; returns one long DataFrame of the flight samples with a column
+    per series.
+    '''
+    frames = [flights[name].assign(flight=name) for name in sorted(flights)]
+    samples = pd.concat(frames, ignore_index=True)
+    times, names, values = station_matrix(series)
+    aligned = align(samples['datetime'].values, times, values, method, tolerance)
+    for name, column in zip(names, aligned):
+        samples[name] = column
+    return samples
@@ -1,23 +1,38 @@
 # -*- coding: utf-8 -*-
-import os
-from os.path import isfile, join
+import uuid
 
 import dash
 import dash_auth
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_table
-from dash.dependencies import Input, Output
+import flask
+from flask_compress import Compress
+from dash.dependencies import ClientsideFunction, Input, Output, State
+from dash.exceptions import PreventUpdate
 import pandas as pd
 import plotly.graph_objs as go
-import mysql.connector
-import configparser
 import objectpath
 import json
-import requests
 import numpy as np
 
-from components import make_dash_table
+import air4thai
+import align
+import catalog
+import derived
+import downsample
+import gridmap
+import jobs
+import live
+from flightcache import flight_cache, flight_path, load_flight
+import metrics
+import packing
+import profiles
+import qa
+import shared
+from stations import get_index, nearest_station
+import tinv
+import warehouse
 
 app = dash.Dash(__name__)
 
@@ -33,18 +48,19 @@ auth = dash_auth.BasicAuth(
 
 server = app.server
 
-config = configparser.ConfigParser()
-config.read('config.ini')
+# after BasicAuth, so /metrics stays open to the scraper; the profiler asks for the login
+metrics.instrument(app, auth)
+metrics.register_cache('flight', flight_cache)
+metrics.register_cache('air4thai', air4thai.cache)
+metrics.register_cache('grid', gridmap.grid_cache)
+# registered last so it runs first, and /metrics counts the compressed bytes
+Compress(server)
 
-mydb = mysql.connector.connect(
-  host=config['DATABASE']['HOST'],
-  user=config['DATABASE']['USER'],
-  passwd=config['DATABASE']['PASSWORD'],
-  database="pollucell"
-)
-
-pathway = '../data/balloon/'
-files = [f for f in os.listdir(pathway) if isfile(join(pathway, f))]
+files = catalog.files()
+# the rescan and warehouse sync threads start in each worker, not in the --preload master
+catalog.watch(server)
+# map the flights before gunicorn forks (--preload) so every worker shares them
+shared.preload_flights(files)
 
 # Create app layout
 app.layout = html.Div(className="container", children=[
@@ -62,6 +78,9 @@ app.layout = html.Div(className="container", children=[
         ''')
     ),
 
+    # new flights are picked up from the catalog without a restart
+    dcc.Interval(id='catalog-interval', interval=catalog.SCAN_INTERVAL * 1000),
+
     dcc.Dropdown(id='filename',
                  options=[
                      {'label': i, 'value': i} for i in files
@@ -76,6 +95,22 @@ app.layout = html.Div(className="container", children=[
         ''')
     ),
 
+    dcc.Checklist(id='live',
+        options=[{'label': 'Live telemetry', 'value': 'live'}],
+        values=[]
+    ),
+
+    dcc.Interval(id='live-interval', interval=1000, disabled=True),
+    dcc.Store(id='overview-rows'),
+    dcc.Store(id='live-rows'),
+    # packed figures, decoded into the graphs by assets/packing.js
+    dcc.Store(id='overview-figure'),
+    dcc.Store(id='tinv-figure'),
+    dcc.Store(id='pm-figure'),
+    # slow callbacks run as background jobs, polled until their result is ready
+    *jobs.components('compare'),
+    *jobs.components('pm'),
+
     dcc.Graph(id='overview-graph'),
 
     html.Table(id='metadata', children=[
@@ -100,6 +135,25 @@ app.layout = html.Div(className="container", children=[
     html.Div(id='tinv-prediction',
         style={'text-align':'center'}),
 
+    html.Div(
+        children=
+        html.H3('''
+        Profile Comparison
+        ''')
+    ),
+
+    dcc.Dropdown(id='compare',
+                 options=[
+                     {'label': i, 'value': i} for i in files
+                 ],
+                 value=files[:1],
+                 multi=True,
+    ),
+
+    dcc.Graph(id='compare-graph'),
+
+    dcc.Graph(id='anomaly-graph'),
+
     html.Div(
         children=
         html.H3('''
@@ -129,23 +183,60 @@ app.layout = html.Div(className="container", children=[
         ],
         style={'margin-left':'auto',
                'margin-right':'auto'}),
+
+    html.Div(
+        children=
+        html.H3('''
+        Pollution Map
+        ''')
+    ),
+
+    dcc.Graph(id='map-graph'),
+
+    dcc.Slider(id='map-hour',
+        min=0,
+        max=23,
+        value=12,
+        marks={h: '{:02d}:00'.format(h) for h in range(0, 24, 3)}
+    ),
 ])
 
+# decode the packed figures in the browser
+for graph in ('overview', 'tinv', 'pm'):
+    app.clientside_callback(
+        ClientsideFunction('pollucell', 'unpack_figure'),
+        Output('{}-graph'.format(graph), 'figure'),
+        [Input('{}-figure'.format(graph), 'data')])
+
 @app.callback(
-    Output(component_id='overview-graph', component_property='figure'),
-    [Input(component_id='filename', component_property='value')]
+    [Output(component_id='overview-figure', component_property='data'),
+     Output(component_id='overview-rows', component_property='data')],
+    [Input(component_id='filename', component_property='value'),
+     Input(component_id='overview-graph', component_property='relayoutData')]
 )
-def update_overview(input_value):
-    file = '../data/balloon/{}'.format(input_value)
-    df = pd.read_csv(file, sep=",")
+def update_overview(input_value, relayout):
+    df = qa.load_clean(input_value)
+    xaxis = {'title': 'Time'}
+    # raw rows read so far, so live mode knows where to continue from
+    rows = {'file': input_value, 'rows': len(load_flight(input_value)), 'token': uuid.uuid4().hex}
+
+    # refetch only the visible window when zoomed, ignoring a zoom left over from another flight
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    zoom = downsample.zoom_window(relayout)
+    if zoom is not None and 'filename.value' not in triggered:
+        df = downsample.window(df, *zoom)
+        xaxis['range'] = [str(zoom[0]), str(zoom[1])]
+
+    x1, y1 = downsample.downsample(df['datetime'].values, df['temp'].values)
+    x2, y2 = downsample.downsample(df['datetime'].values, df['alt'].values)
     trace1 = go.Scatter(
-              x= df['datetime'],
-              y= df['temp'],
+              x= x1,
+              y= y1,
               name= 'Temperature (°C)'
              )
     trace2 = go.Scatter(
-              x= df['datetime'],
-              y= df['alt'],
+              x= x2,
+              y= y2,
               name= 'Altitude (m)'
              )
 
@@ -154,11 +245,57 @@ def update_overview(input_value):
     fig = {
             'data': data,
             'layout': {
-                      'xaxis': {'title': 'Time'},
-                      'yaxis': {'title': "Value"}
+                      'xaxis': xaxis,
+                      'yaxis': {'title': "Value"},
+                      # keep the user's zoom when the figure is refreshed
+                      'uirevision': input_value
                       }
           }
-    return fig
+    return packing.pack_figure(fig), rows
+
+@app.callback(
+    Output('live-interval', 'disabled'),
+    [Input('live', 'values')])
+def toggle_live(live_values):
+    return 'live' not in live_values
+
+@app.callback(
+    [Output('overview-graph', 'extendData'),
+     Output('live-rows', 'data')],
+    [Input('live-interval', 'n_intervals')],
+    [State('filename', 'value'),
+     State('overview-rows', 'data'),
+     State('live-rows', 'data')])
+def extend_overview(n_intervals, input_value, overview_rows, live_rows):
+    if not n_intervals or not overview_rows or overview_rows['file'] != input_value:
+        raise PreventUpdate
+    # continue from our last tick unless the overview was redrawn since
+    seen = overview_rows
+    if live_rows and live_rows['token'] == overview_rows['token']:
+        seen = live_rows
+
+    new, rows = live.get_flight(flight_path(input_value)).rows_since(seen['rows'])
+    if not len(new):
+        raise PreventUpdate
+    # the overview's x axis holds epoch milliseconds, as packed by packing.pack
+    x = new['datetime'].values.astype('datetime64[ms]').astype('int64')
+    extend = [{'x': [x, x], 'y': [new['temp'].values, new['alt'].values]}, [0, 1]]
+    return extend, {'file': input_value, 'rows': rows, 'token': overview_rows['token']}
+
+def current_profile(input_value, live_values):
+    ''' Return the TINV profile of a flight, from the live tail while live mode is on '''
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if live_values and 'live' in live_values and 'live-interval.n_intervals' in triggered:
+        return live.get_flight(flight_path(input_value)).profile()
+    return tinv.load_profile(input_value)
+
+@app.callback(
+    [Output('filename', 'options'),
+     Output('compare', 'options')],
+    [Input('catalog-interval', 'n_intervals')])
+def update_files(n_intervals):
+    options = [{'label': i, 'value': i} for i in catalog.files()]
+    return options, options
 
 @app.callback(
     [Output('meta-name', 'children'),
@@ -169,122 +306,156 @@ def update_overview(input_value):
     [Input(component_id='filename', component_property='value')]
 )
 def update_metadata(input_value):
-    file = '../data/balloon/{}'.format(input_value)
-    df = pd.read_csv(file, sep=',')
-    name = "Balloon Launch at Main Grass Field CU"
-    df['datetime'] =  pd.to_datetime(df['datetime'])
-    time = df['datetime'].min().strftime("%H:%M:%S")+" - "+df['datetime'].max().strftime("%H:%M:%S")
-    date = df['datetime'].min().strftime("%d/%m/%y")
-    clat = 13.738548
-    clong = 100.530846
+    site = catalog.get(input_value)['site']
+    start, end = catalog.time_range(input_value)
+    name = site['name']
+    time = start.strftime("%H:%M:%S")+" - "+end.strftime("%H:%M:%S")
+    date = start.strftime("%d/%m/%y")
+    clat = site['lat']
+    clong = site['long']
 
     return name, date, time, clat, clong 
 
 @app.callback(
-    Output(component_id='tinv-graph', component_property='figure'),
-    [Input(component_id='filename', component_property='value')]
+    Output(component_id='tinv-figure', component_property='data'),
+    [Input(component_id='filename', component_property='value'),
+     Input(component_id='live-interval', component_property='n_intervals')],
+    [State(component_id='live', component_property='values')]
 )
-def update_tinv(input_value):
-    file = '../data/balloon/{}'.format(input_value)
-    df = pd.read_csv(file, sep=",")
-    bins = np.arange(0,df['alt'].max() + 1, 1)
-    df['bins'] = pd.cut(df['alt'], bins, labels=False)
-    df = df.groupby('bins').mean()
-    iroc = -df['temp'].diff(periods=5) / df['alt'].diff(periods=5)
-    if iroc.min()<-0.1:
-        tinv_start = iroc.idxmin()-5
-        tinv_end = iroc.idxmin()+5
-    else:
-        tinv_start = iroc.idxmin() #highlight nothing
-        tinv_end = iroc.idxmin()
+def update_tinv(input_value, n_intervals, live_values):
+    profile = current_profile(input_value, live_values)
     trace1 = go.Scatter(
-              x= df.index,
-              y= df['temp'],
+              x= profile.bins,
+              y= profile.temp,
               name= 'tinv'
              )
 
     data = [trace1]
+    if not (live_values and 'live' in live_values):
+        # potential temperature rising with height marks the stable layers
+        bins, theta = derived.theta_profile(input_value)
+        data.append(go.Scatter(x=bins, y=theta, name='Potential temperature', yaxis='y2'))
 
     fig = {
            'data': data,
            'layout': {
                      'xaxis': {'title': 'Altitude (m)'},
                      'yaxis': {'title': 'Temperature (°C)'},
+                     'yaxis2': {'title': 'Potential temperature (K)',
+                                'overlaying': 'y', 'side': 'right'},
                      'shapes': [
-                               # highlight tinv
+                               # highlight every tinv layer
                                {
                                      'type': 'rect',
                                      # x-reference is assigned to the x-values
                                      'xref': 'x',
                                      # y-reference is assigned to the plot paper [0,1]
                                      'yref': 'paper',
-                                     'x0': tinv_start,
+                                     'x0': layer.start,
                                      'y0': 0,
-                                     'x1': tinv_end,
+                                     'x1': layer.end,
                                      'y1': 1,
                                      'fillcolor': 'rgba(255, 131, 16, 0.2)',
                                      'line': {
                                          'width': 0,
                                      }
                                }
+                               for layer in profile.layers
                                ]
                        },
            }
-    return fig
+    return packing.pack_figure(fig)
 
 @app.callback(
     Output('tinv-prediction', 'children'),
-    [Input(component_id='filename', component_property='value')]
+    [Input(component_id='filename', component_property='value'),
+     Input(component_id='live-interval', component_property='n_intervals')],
+    [State(component_id='live', component_property='values')]
 )
-def update_metadata(input_value):
-    file = '../data/balloon/{}'.format(input_value)
-    df = pd.read_csv(file, sep=',')
-    df['datetime'] =  pd.to_datetime(df['datetime'])
-    bins = np.arange(0,df['alt'].max() + 1, 1)
-    df['bins'] = pd.cut(df['alt'], bins, labels=False)
-    df = df.groupby('bins').mean()
-    iroc = -df['temp'].diff(periods=5) / df['alt'].diff(periods=5)
-    if iroc.min()<-0.1:
-        tinv_alt = iroc.idxmin()
-        return "Suspect TINV layer around "+str(tinv_alt)+" meters"
+def update_prediction(input_value, n_intervals, live_values):
+    layer = tinv.strongest(current_profile(input_value, live_values))
+    if layer is not None:
+        return "Suspect TINV layer around {:g} meters".format(layer.peak)
     else:
         return "No TINV layer found" 
 
 
-@app.callback(
-   Output(component_id='pm-graph', component_property='figure'),
-   [Input(component_id='pm', component_property='value'),
-    Input(component_id='filename', component_property='value')])
-def update_pm(input_pm, input_value):
-    file = '../data/balloon/{}'.format(input_value)
-    df = pd.read_csv(file)
-    df['datetime'] =  pd.to_datetime(df['datetime'])
-    uav_start = df.datetime.min()
-    uav_end = df.datetime.max()
-    uav_date = df.datetime[0]
+@jobs.background(app, 'compare',
+    [Output('compare-graph', 'figure'),
+     Output('anomaly-graph', 'figure')],
+    [Input('compare', 'value')])
+def update_compare(filenames):
+    if not filenames:
+        raise PreventUpdate
+    matrix = profiles.profile_matrix(filenames)
+    # every catalogued flight's row is cached, so this only loads new flights
+    climatology = profiles.statistics(profiles.profile_matrix(catalog.files()))[0]
+    mean, (low, high) = profiles.statistics(matrix)
+    top = profiles.reached(matrix)
+    alt = profiles.GRID[:top]
+
+    data = [go.Scatter(x=low[:top], y=alt, name='10th percentile',
+                       line={'width': 0}, showlegend=False),
+            go.Scatter(x=high[:top], y=alt, name='10-90th percentile', fill='tonextx',
+                       fillcolor='rgba(10, 171, 46, 0.2)', line={'width': 0})]
+    data += [go.Scatter(x=row[:top], y=alt, name=name, opacity=0.6)
+             for name, row in zip(filenames, matrix)]
+    data.append(go.Scatter(x=mean[:top], y=alt, name='Mean', line={'width': 3}))
+    fig = {
+           'data': data,
+           'layout': {
+                     'xaxis': {'title': 'Temperature (°C)'},
+                     'yaxis': {'title': 'Altitude (m)'}
+                     }
+           }
+
+    anomalies = profiles.anomaly(matrix, climatology)
+    anomaly_fig = {
+           'data': [go.Scatter(x=row[:top], y=alt, name=name)
+                    for name, row in zip(filenames, anomalies)],
+           'layout': {
+                     'xaxis': {'title': 'Departure from all flights (°C)'},
+                     'yaxis': {'title': 'Altitude (m)'}
+                     }
+           }
+    return fig, anomaly_fig
+
+
+def station_window(uav_date):
+    ''' Return the station history date range around a flight date '''
     sdate = uav_date + pd.DateOffset(days=-1)
     sdate = sdate.strftime('%y-%m-%d')
     edate = uav_date + pd.DateOffset(days=1)
     edate = edate.strftime('%y-%m-%d')
-    stationId = "50t"
+    return sdate, edate
+
+def flight_windows():
+    ''' Return the station history date range of every catalogued flight '''
+    return [station_window(catalog.time_range(f)[0]) for f in catalog.files()]
+
+# the warehouse only keeps the days the flights need
+warehouse.watch(server, flight_windows)
+
+@jobs.background(app, 'pm',
+   Output(component_id='pm-figure', component_property='data'),
+   [Input(component_id='pm', component_property='value'),
+    Input(component_id='filename', component_property='value')],
+   # a flight flown today shows readings that are still coming in
+   ttl=air4thai.TODAY_TTL)
+def update_pm(input_pm, input_value):
+    site = catalog.get(input_value)['site']
+    uav_start, uav_end = catalog.time_range(input_value)
+    sdate, edate = station_window(uav_start)
+    stationId = nearest_station(site['lat'], site['long'])['stationID']
     param = input_pm
     stime = "00"
     etime = "24"
-    r = requests.get('http://air4thai.pcd.go.th/webV2/history/api/data.php?'
-                     +'stationID='+stationId
-                     +'&param='+param
-                     +'&type=hr&sdate='+sdate
-                     +'&edate='+edate
-                     +'&stime='+stime
-                     +'&etime='+etime)
-    source = r.json()
-    data = source['stations'][0]['data']
-    df1 = pd.DataFrame(data)
-    df1.columns = ['datetime', 'value']
+    df1 = warehouse.history(stationId, param, sdate, edate, stime, etime)
 
+    x, y = downsample.downsample(pd.to_datetime(df1['datetime']).values, df1['value'].values)
     trace = go.Scatter(
-        x = df1['datetime'],
-        y = df1['value']
+        x = x,
+        y = y
     )
 
     data2 = [trace]
@@ -311,7 +482,7 @@ def update_pm(input_pm, input_value):
     }
 
     fig={'data': data2, 'layout': layout}
-    return fig
+    return packing.pack_figure(fig)
 
 @app.callback(
         [Output('pm-name', 'children'),
@@ -320,11 +491,79 @@ def update_pm(input_pm, input_value):
         Output('pm-long', 'children')],
         [Input(component_id='filename', component_property='value')])
 def update_pm_meta(input_value):
-    name = "โรงพยาบาลจุฬาลงกรณ์"
-    sid = '50t'
-    slat = '13.731576', 
-    slong = '100.534390'
+    # start fetching every pollutant as soon as a flight is selected
+    site = catalog.get(input_value)['site']
+    sdate, edate = station_window(catalog.time_range(input_value)[0])
+    station = nearest_station(site['lat'], site['long'])
+    warehouse.prefetch(station['stationID'], air4thai.PARAMS, sdate, edate)
+
+    name = station['nameTH']
+    sid = station['stationID']
+    slat = station['lat']
+    slong = station['long']
     return name, sid, slat, slong
 
+
+def aligned_flight(filename, method='linear'):
+    ''' Return the flight's clean samples with the nearest station's pollutants attached '''
+    site = catalog.get(filename)['site']
+    sdate, edate = station_window(catalog.time_range(filename)[0])
+    stationId = nearest_station(site['lat'], site['long'])['stationID']
+    series = {param: warehouse.history(stationId, param, sdate, edate)
+              for param in air4thai.PARAMS}
+    return align.align_flights({filename: qa.load_clean(filename)}, series, method)
+
+
+@server.route('/export/<filename>')
+def export_flight(filename):
+    # registered after BasicAuth, so check the credentials here
+    if not auth.is_authorized():
+        return auth.login_request()
+    if filename not in catalog.files():
+        flask.abort(404)
+    method = flask.request.args.get('method', 'linear')
+    if method not in ('backward', 'forward', 'nearest', 'linear'):
+        flask.abort(400)
+    df = aligned_flight(filename, method).drop(columns='flight')
+    return flask.Response(
+        df.to_csv(index=False), mimetype='text/csv',
+        headers={'Content-Disposition': 'attachment; filename=aligned_{}'.format(filename)})
+
+@app.callback(
+    Output('map-graph', 'figure'),
+    [Input('pm', 'value'),
+     Input('map-hour', 'value'),
+     Input('filename', 'value')])
+def update_map(input_pm, hour, input_value):
+    day = catalog.time_range(input_value)[0].normalize()
+    grid = gridmap.hour_map(input_pm, day + pd.Timedelta(hours=hour))
+    lats, longs = gridmap.grid_axes()
+    lat0, lat1, long0, long1 = gridmap.BOUNDS
+    index = get_index()
+    inside = ((index.lat >= lat0) & (index.lat <= lat1)
+              & (index.long >= long0) & (index.long <= long1))
+    site = catalog.get(input_value)['site']
+
+    data = [
+        go.Heatmap(x=longs, y=lats, z=np.round(grid, 1), colorscale='YlOrRd',
+                   zmin=0, colorbar={'title': input_pm}),
+        go.Scatter(x=index.long[inside], y=index.lat[inside], mode='markers',
+                   text=index.stations['stationID'][inside], name='Stations',
+                   marker={'color': 'black', 'size': 6}),
+        go.Scatter(x=[site['long']], y=[site['lat']], mode='markers', name=site['name'],
+                   marker={'color': 'rgb(10, 171, 46)', 'size': 12, 'symbol': 'star'}),
+    ]
+    fig = {
+           'data': data,
+           'layout': {
+                     'title': '{} at {:%Y-%m-%d %H:00}'.format(input_pm, day + pd.Timedelta(hours=hour)),
+                     'xaxis': {'title': 'Longitude'},
+                     'yaxis': {'title': 'Latitude', 'scaleanchor': 'x'},
+                     # keep the zoom while scrubbing through the hours
+                     'uirevision': input_value
+                     }
+           }
+    return fig
+
 if __name__ == '__main__':
     app.run_server(debug=True)
@@ -8,42 +8,41 @@ import dash_table
 from dash.dependencies import Input, Output
 import pandas as pd
 import plotly.graph_objs as go
-import mysql.connector
-import configparser
 import objectpath
 import json
-import requests
 
-from components import make_dash_table
+from components.table import PAGE_SIZE
+import db
+import mavlink
+import shared
+import warehouse
+import xcorr
 
 app = dash.Dash(__name__)
 
 server = app.server
 
 # Load data
-df = pd.read_csv('../sampledata/rsl_pm25.csv') #relative path - need to execute app inside /dashboard
-#print(df)
-
-config = configparser.ConfigParser()
-config.read('config.ini')
-
-mydb = mysql.connector.connect(
-  host=config['DATABASE']['HOST'],
-  user=config['DATABASE']['USER'],
-  passwd=config['DATABASE']['PASSWORD'],
-  database="pollucell"
-)
+def read_rsl(path):
+    df = pd.read_csv(path)
+    df['dateTime'] = pd.to_datetime(df['dateTime']).dt.tz_convert(None)
+    return df
 
-#print(mydb)
+# one read-only copy in shared memory for every worker
+df = shared.load_frame('rsl_pm25', '../sampledata/rsl_pm25.csv', read_rsl) #relative path - need to execute app inside /dashboard
+#print(df)
 
-df2 = pd.read_sql('SELECT * FROM TestTable', con=mydb)
-#print(df2)
+# longest lag in hours shown on the correlation panel
+MAX_LAG = 72
 
 pathway = '../data/'
 files = [f for f in os.listdir(pathway) if isfile(join(pathway, f))]
 
-# Create app layout
+# static, so Dash can validate it at import without touching MySQL;
+# the TestTable columns and graph are loaded by callbacks on page load
 app.layout = html.Div(className="container", children=[
+    dcc.Location(id='url'),
+
     html.Div(
         className="app-header",
         children=[
@@ -104,41 +103,42 @@ app.layout = html.Div(className="container", children=[
             )
         }
     ),
+
+    html.Div(children=[
+        html.H3('Signal strength vs PM2.5 correlation')
+    ]),
+
+    dcc.Slider(id='xcorr-window',
+        min=6,
+        max=168,
+        step=6,
+        value=24,
+        marks={h: '{}h'.format(h) for h in (6, 24, 48, 72, 168)}
+    ),
+
+    dcc.Graph(id='xcorr-lag-graph'),
+
+    dcc.Graph(id='xcorr-rolling-graph'),
     html.Div(children=[
         html.H3('MySQL: TestTable')
     ]),
 
     html.Div([
+        # paged, sorted and filtered in MySQL by update_table
         dash_table.DataTable(
         id='test-table',
-        columns=[{"name": i, "id": i} for i in df2.columns],
-        data=df2.to_dict("rows"),
-        )
+        pagination_mode='be',
+        pagination_settings={'current_page': 0, 'page_size': PAGE_SIZE},
+        sorting='be',
+        sorting_type='multi',
+        sort_by=[],
+        filtering='be',
+        filter='',
+        ),
+        html.Div(id='test-table-count')
     ]),
 
-    dcc.Graph(
-        id='example-graph-2',
-        figure={
-            'data': [
-                go.Scatter(
-                    x=df2['Column1'],
-                    y=df2['Column2'],
-                    name='x = Column1'
-                ),
-                go.Scatter(
-                    x=df2['Column2'],
-                    y=df2['Column1'],
-                    name='x = Column2'
-                )
-
-            ],
-            'layout': go.Layout(
-                title='Graph From TestTable',
-                xaxis={'title': 'x'},
-                yaxis={'title': 'y'}
-            )
-        }
-    )
+    dcc.Graph(id='example-graph-2')
 
 ])
 
@@ -147,21 +147,7 @@ app.layout = html.Div(className="container", children=[
     [Input(component_id='filename', component_property='value')]
 )
 def update_figure(input_value):
-    file = '../data/{}'.format(input_value)
-    with open(file,'r') as f:
-        targets_1 = [line for line in f if "mavlink_scaled_pressure_t" in line]
-
-    df_1 = pd.DataFrame(targets_1, columns=["c"])
-    df_1_2 = pd.DataFrame(df_1.c.str.split(',').tolist(),
-                                   columns = ['c1','c2','c3','c4','c5','c6','c7','c8','c9','c10'
-                                             ,'c11','c12','c13','c14','c15','c16','c17','c18','c19','c20'
-                                             ,'c21','c22'])
-    df_1_3 = df_1_2.filter(['c1','c14','c16','c18'], axis=1)
-    df_1_4 = df_1_3.rename(index=str, columns={"c1": "datetime", "c14": "press_abs", "c16": "press_diff", "c18": "temperature"})
-    df_1_4['datetime']= df_1_4['datetime'].astype('datetime64')
-    df_1_4['press_abs']= df_1_4['press_abs'].astype('float')
-    df_1_4['press_diff']= df_1_4['press_diff'].astype('float')
-    df_1_4['temperature']= df_1_4['temperature'].astype('float')
+    df_1_4 = mavlink.load_scaled_pressure(input_value, pathway)
 
     fig = {
         'data': [
@@ -182,21 +168,7 @@ def update_figure(input_value):
    [Input(component_id='pm', component_property='value'),
     Input(component_id='filename', component_property='value')])
 def update_pm(input_pm, input_value):
-    file = '../data/{}'.format(input_value)
-    with open(file,'r') as f:
-        targets_1 = [line for line in f if "mavlink_scaled_pressure_t" in line]
-
-    df_1 = pd.DataFrame(targets_1, columns=["c"])
-    df_1_2 = pd.DataFrame(df_1.c.str.split(',').tolist(),
-                                   columns = ['c1','c2','c3','c4','c5','c6','c7','c8','c9','c10'
-                                             ,'c11','c12','c13','c14','c15','c16','c17','c18','c19','c20'
-                                             ,'c21','c22'])
-    df_1_3 = df_1_2.filter(['c1','c14','c16','c18'], axis=1)
-    df_1_4 = df_1_3.rename(index=str, columns={"c1": "datetime", "c14": "press_abs", "c16": "press_diff", "c18": "temperature"})
-    df_1_4['datetime']= df_1_4['datetime'].astype('datetime64')
-    df_1_4['press_abs']= df_1_4['press_abs'].astype('float')
-    df_1_4['press_diff']= df_1_4['press_diff'].astype('float')
-    df_1_4['temperature']= df_1_4['temperature'].astype('float')
+    df_1_4 = mavlink.load_scaled_pressure(input_value, pathway)
 
     uav_start = df_1_4.datetime.min()
     uav_end = df_1_4.datetime.max()
@@ -209,17 +181,7 @@ def update_pm(input_pm, input_value):
     param = input_pm
     stime = "00"
     etime = "24"
-    r = requests.get('http://air4thai.pcd.go.th/webV2/history/api/data.php?'
-                     +'stationID='+stationId
-                     +'&param='+param
-                     +'&type=hr&sdate='+sdate
-                     +'&edate='+edate
-                     +'&stime='+stime
-                     +'&etime='+etime)
-    source = r.json()
-    data = source['stations'][0]['data']
-    df1 = pd.DataFrame(data)
-    df1.columns = ['datetime', 'value']
+    df1 = warehouse.history(stationId, param, sdate, edate, stime, etime)
 
     trace = go.Scatter(
         x = df1['datetime'],
@@ -252,5 +214,84 @@ def update_pm(input_pm, input_value):
     fig={'data': data2, 'layout': layout}
     return fig
 
+@app.callback(
+    [Output('xcorr-lag-graph', 'figure'),
+     Output('xcorr-rolling-graph', 'figure')],
+    [Input('xcorr-window', 'value')])
+def update_xcorr(window):
+    # correlate on a regular hourly grid, gaps left as NaN
+    hourly = df.set_index('dateTime')[['Signal_strength', 'value']].resample('60min').mean()
+    rsl = hourly['Signal_strength'].values
+    pm = hourly['value'].values
+
+    lags, r = xcorr.lagged_xcorr(rsl, pm, MAX_LAG)
+    lag, best = xcorr.best_lag(lags, r)
+    rolling = xcorr.rolling_corr(rsl, pm, window, min_periods=window // 2)
+
+    lag_fig = {
+        'data': [go.Scatter(x=lags, y=r, name='r')],
+        'layout': go.Layout(
+            title='Strongest correlation r = {:.2f} with PM2.5 {} h after signal strength'.format(
+                float(best), int(lag)),
+            xaxis={'title': 'Lag (hours)'},
+            yaxis={'title': 'Correlation', 'range': [-1, 1]}
+        )
+    }
+    rolling_fig = {
+        'data': [go.Scatter(x=hourly.index, y=rolling, name='r')],
+        'layout': go.Layout(
+            title='{} h rolling correlation'.format(window),
+            xaxis={'title': 'Date and time'},
+            yaxis={'title': 'Correlation', 'range': [-1, 1]}
+        )
+    }
+    return lag_fig, rolling_fig
+
+@app.callback(
+    Output('test-table', 'columns'),
+    [Input('url', 'pathname')])
+def update_table_columns(pathname):
+    return [{"name": i, "id": i} for i in db.table_columns('TestTable')]
+
+@app.callback(
+    [Output('test-table', 'data'),
+     Output('test-table-count', 'children')],
+    [Input('test-table', 'pagination_settings'),
+     Input('test-table', 'sort_by'),
+     Input('test-table', 'filter')])
+def update_table(pagination_settings, sort_by, query):
+    page = pagination_settings['current_page']
+    page_size = pagination_settings['page_size']
+    rows, total = db.read_page('TestTable', page, page_size, sort_by, query)
+    first = min(page * page_size + 1, total)
+    return rows.to_dict('rows'), 'Rows {}-{} of {}'.format(first, page * page_size + len(rows), total)
+
+@app.callback(
+    Output('example-graph-2', 'figure'),
+    [Input('test-table', 'filter')])
+def update_test_graph(query):
+    # only the two plotted columns, and only the rows the table filter keeps
+    df2 = db.read_table('TestTable', columns=['Column1', 'Column2'], query=query)
+    return {
+        'data': [
+            go.Scatter(
+                x=df2['Column1'],
+                y=df2['Column2'],
+                name='x = Column1'
+            ),
+            go.Scatter(
+                x=df2['Column2'],
+                y=df2['Column1'],
+                name='x = Column2'
+            )
+        ],
+        'layout': go.Layout(
+            title='Graph From TestTable',
+            xaxis={'title': 'x'},
+            yaxis={'title': 'y'}
+        )
+    }
+
+
 if __name__ == '__main__':
     app.run_server(debug=True)
@@ -0,0 +1,49 @@
+/* Decode figures packed by packing.py: base64 typed arrays back into trace arrays */
+(function () {
+    function bytes(b64) {
+        var raw = window.atob(b64);
+        var out = new Uint8Array(raw.length);
+        for (var i = 0; i < raw.length; i++) {
+            out[i] = raw.charCodeAt(i);
+        }
+        return out.buffer;
+    }
+
+    function unpack(value) {
+        if (!value || typeof value.bdata !== 'string') {
+            return value;
+        }
+        var buffer = bytes(value.bdata);
+        if (value.dtype === 'float32') {
+            return new Float32Array(buffer);
+        }
+        if (value.dtype === 'int64') {
+            // little-endian int64 milliseconds; exact as doubles up to 2^53
+            var words = new Int32Array(buffer);
+            var ms = new Float64Array(words.length / 2);
+            for (var j = 0; j < ms.length; j++) {
+                ms[j] = (words[2 * j] >>> 0) + words[2 * j + 1] * 4294967296;
+            }
+            return ms;
+        }
+        return value;
+    }
+
+    window.pollucell = Object.assign(window.pollucell || {}, {
+        unpack_figure: function (packed) {
+            if (!packed) {
+                return {data: [], layout: {}};
+            }
+            var data = packed.data.map(function (trace) {
+                var copy = Object.assign({}, trace);
+                ['x', 'y'].forEach(function (key) {
+                    if (key in trace) {
+                        copy[key] = unpack(trace[key]);
+                    }
+                });
+                return copy;
+            });
+            return {data: data, layout: packed.layout};
+        }
+    });
+})();
@@ -0,0 +1,177 @@
+''' Persisted catalog of balloon flights
+
+For every flight the catalog keeps its time range, sample count, altitude
+range, launch site and a TINV summary, so the dashboard can list flights and
+show their metadata without touching the raw data. It is kept up to date by
+an mtime scan of the balloon directory: only new or changed files are
+re-read, and a background thread repeats the scan every SCAN_INTERVAL
+seconds.
+
+The thread is started by watch(server) on a worker's first request, never at
+import: under gunicorn --preload the import runs in the master, and a
+watcher there could be holding _lock when a worker forks.
+'''
+import json
+import os
+import threading
+import time
+
+import pandas as pd
+
+import flightcache
+import qa
+import tinv
+
+# outside data/, which app_v2 lists as MAVLink logs
+catalogway = '../cache/catalog.json'
+SCAN_INTERVAL = 30
+
+# every flight so far was launched from the same field
+LAUNCH_SITE = {'name': "Balloon Launch at Main Grass Field CU",
+               'lat': 13.738548,
+               'long': 100.530846}
+
+_entries = {}
+_loaded_mtime = None
+_lock = threading.RLock()
+_watcher_pid = None
+_watcher_lock = threading.Lock()
+
+
+def summarize(filename):
+    ''' Build the catalog entry of one flight '''
+    path = flightcache.flight_path(filename)
+    stat = os.stat(path)
+    df = qa.load_clean(filename)
+    flagged = int((~qa.load_mask(filename)).sum())
+    profile = tinv.load_profile(filename)
+    layer = tinv.strongest(profile)
+    return {
+        'file': filename,
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+        'start': str(df['datetime'].min()),
+        'end': str(df['datetime'].max()),
+        'samples': len(df) + flagged,
+        'flagged': flagged,
+        'alt_min': float(df['alt'].min()),
+        'alt_max': float(df['alt'].max()),
+        'site': LAUNCH_SITE,
+        'tinv': {
+            'layers': len(profile.layers),
+            'peak': None if layer is None else float(layer.peak),
+            'start': None if layer is None else float(layer.start),
+            'end': None if layer is None else float(layer.end),
+            'strength': None if layer is None else float(layer.strength),
+        },
+    }
+
+
+def _load():
+    # pick up entries another worker has already written
+    global _entries, _loaded_mtime
+    try:
+        mtime = os.path.getmtime(catalogway)
+    except OSError:
+        return
+    if mtime == _loaded_mtime:
+        return
+    try:
+        with open(catalogway) as f:
+            _entries = {entry['file']: entry for entry in json.load(f)}
+        _loaded_mtime = mtime
+    except ValueError:
+        pass
+
+
+def _save():
+    global _loaded_mtime
+    directory = os.path.dirname(catalogway)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = '{}.{}.tmp'.format(catalogway, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(sorted(_entries.values(), key=lambda e: e['file']), f, indent=1)
+    os.replace(tmp, catalogway)
+    _loaded_mtime = os.path.getmtime(catalogway)
+
+
+def scan():
+    ''' Bring the catalog up to date with the balloon directory and return True if it changed '''
+    with _lock:
+        _load()
+        changed = False
+        present = set()
+        for filename in os.listdir(flightcache.pathway):
+            path = flightcache.flight_path(filename)
+            if not filename.endswith('.csv') or not os.path.isfile(path):
+                continue
+            present.add(filename)
+            stat = os.stat(path)
+            entry = _entries.get(filename)
+            if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+                _entries[filename] = summarize(filename)
+                changed = True
+        for filename in set(_entries) - present:
+            del _entries[filename]
+            changed = True
+        if changed:
+            _save()
+        return changed
+
+
+def _watch():
+    while True:
+        time.sleep(SCAN_INTERVAL)
+        try:
+            scan()
+        except Exception:
+            # a flight caught mid-write is picked up again on the next scan
+            pass
+
+
+def start_watcher():
+    ''' Start this process's background scan thread, once per process '''
+    global _watcher_pid
+    if _watcher_pid == os.getpid():
+        return
+    # not _lock, which a running scan holds for as long as it takes
+    with _watcher_lock:
+        if _watcher_pid == os.getpid():
+            return
+        _watcher_pid = os.getpid()
+    thread = threading.Thread(target=_watch, name='catalog-watcher')
+    thread.daemon = True
+    thread.start()
+
+
+def watch(server):
+    ''' Start the background scan in each process serving server, on its first request '''
+    server.before_request(start_watcher)
+
+
+def _ensure():
+    if not _entries:
+        scan()
+
+
+def files():
+    ''' Return the catalogued flight file names, sorted '''
+    _ensure()
+    return sorted(_entries)
+
+
+def get(filename):
+    ''' Return the catalog entry of a flight '''
+    _ensure()
+    entry = _entries.get(filename)
+    if entry is None:
+        scan()
+        entry = _entries[filename]
+    return entry
+
+
+def time_range(filename):
+    ''' Return the (start, end) Timestamps of a flight '''
+    entry = get(filename)
+    return pd.Timestamp(entry['start']), pd.Timestamp(entry['end'])
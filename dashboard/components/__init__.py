@@ -1 +1 @@
-from .table import make_dash_table
+from .table import make_dash_table, parse_filter
@@ -1,5 +1,14 @@
+import re
+
 import dash_html_components as html
 
+PAGE_SIZE = 50
+
+# one clause of a DataTable filter string, e.g. {Column1} >= 3
+CLAUSE = re.compile(r'^\{(\w+)\}\s*(=|eq|!=|ne|>=|ge|<=|le|>|gt|<|lt|contains|datestartswith)\s*(.*)$')
+OPERATORS = {'eq': '=', 'ne': '!=', 'ge': '>=', 'le': '<=', 'gt': '>', 'lt': '<'}
+
+
 def make_dash_table(df):
     ''' Return a dash definition of an HTML table for a Pandas dataframe '''
     table = []
@@ -9,3 +18,18 @@ def make_dash_table(df):
             html_row.append(html.Td([row[i]]))
         table.append(html.Tr(html_row))
     return table
+
+
+def parse_filter(query):
+    ''' Split a DataTable filter string into (column, operator, value) clauses '''
+    clauses = []
+    for part in (query or '').split(' && '):
+        match = CLAUSE.match(part.strip())
+        if not match:
+            continue
+        column, op, value = match.groups()
+        value = value.strip()
+        if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'`':
+            value = value[1:-1]
+        clauses.append((column, OPERATORS.get(op, op), value))
+    return clauses
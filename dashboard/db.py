@@ -0,0 +1,176 @@
+''' MySQL access through a lazily created, per-process connection pool
+
+The pool is only created on first use and is rebuilt whenever the process
+id changes, so a gunicorn worker never reuses a connection it inherited from
+the master. Results are streamed in chunks with fetchmany, and read_table
+pushes column selection, time-range and DataTable filters down into the SQL.
+read_page does the same for a DataTable page: filter, sort, LIMIT/OFFSET and
+a COUNT. Column ids sent by the browser are checked against the table's
+columns, and clauses on unknown columns are skipped.
+'''
+import configparser
+import os
+import re
+import threading
+from contextlib import contextmanager
+
+import mysql.connector.pooling
+import pandas as pd
+
+from components import parse_filter
+
+configway = 'config.ini'
+DATABASE = 'pollucell'
+POOL_SIZE = 4
+CHUNKSIZE = 5000
+
+IDENTIFIER = re.compile(r'^\w+$')
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    ''' Return this process's connection pool, creating it on first use '''
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            config = configparser.ConfigParser()
+            config.read(configway)
+            _pool = mysql.connector.pooling.MySQLConnectionPool(
+                pool_name='pollucell-{}'.format(os.getpid()),
+                pool_size=POOL_SIZE,
+                host=config['DATABASE']['HOST'],
+                user=config['DATABASE']['USER'],
+                passwd=config['DATABASE']['PASSWORD'],
+                database=DATABASE
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+@contextmanager
+def connection():
+    ''' Borrow a connection from the pool and hand it back afterwards '''
+    cnx = get_pool().get_connection()
+    try:
+        yield cnx
+    finally:
+        cnx.close()
+
+
+def quote(name):
+    ''' Backtick-quote a table or column name, rejecting anything but word characters '''
+    if not IDENTIFIER.match(name):
+        raise ValueError('invalid identifier {!r}'.format(name))
+    return '`{}`'.format(name)
+
+
+def iter_query(sql, params=None, chunksize=CHUNKSIZE):
+    ''' Run a query and yield its result as DataFrames of at most chunksize rows '''
+    with connection() as cnx:
+        cursor = cnx.cursor()
+        try:
+            cursor.execute(sql, params or ())
+            columns = cursor.column_names
+            rows = cursor.fetchmany(chunksize)
+            # an empty result still yields one frame so callers see the columns
+            yield pd.DataFrame(rows, columns=columns)
+            while rows:
+                rows = cursor.fetchmany(chunksize)
+                if rows:
+                    yield pd.DataFrame(rows, columns=columns)
+        finally:
+            # drop anything a caller stopped reading so the connection can go back to the pool
+            cnx.consume_results()
+            cursor.close()
+
+
+def read_query(sql, params=None, chunksize=CHUNKSIZE):
+    ''' Run a query and return its whole result as one DataFrame '''
+    return pd.concat(iter_query(sql, params, chunksize), ignore_index=True)
+
+
+def select(table, columns=None, time_column=None, start=None, end=None, query=None, known=None):
+    ''' Build a SELECT for a table with optional columns, a [start, end) time range and a filter '''
+    sql = 'SELECT {} FROM {}'.format(
+        ', '.join(quote(c) for c in columns) if columns else '*', quote(table))
+    where, params = filter_clauses(query, known)
+    if start is not None:
+        where.append('{} >= %s'.format(quote(time_column)))
+        params.append(start)
+    if end is not None:
+        where.append('{} < %s'.format(quote(time_column)))
+        params.append(end)
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    return sql, params
+
+
+def iter_table(table, columns=None, time_column=None, start=None, end=None, query=None,
+               chunksize=CHUNKSIZE):
+    ''' Yield chunks of a table, reading only the given columns, time range and filter '''
+    known = table_columns(table) if query else None
+    sql, params = select(table, columns, time_column, start, end, query, known)
+    return iter_query(sql, params, chunksize)
+
+
+def read_table(table, columns=None, time_column=None, start=None, end=None, query=None,
+               chunksize=CHUNKSIZE):
+    ''' Return a table as one DataFrame, reading only the given columns, time range and filter '''
+    known = table_columns(table) if query else None
+    sql, params = select(table, columns, time_column, start, end, query, known)
+    return read_query(sql, params, chunksize)
+
+
+def table_columns(table):
+    ''' Return a table's column names without reading any rows '''
+    return list(read_query('SELECT * FROM {} LIMIT 0'.format(quote(table))).columns)
+
+
+def filter_clauses(query, known=None):
+    ''' Translate a DataTable filter string into WHERE conditions and their params
+
+    Clauses on columns not in known, when it is given, are skipped.
+    '''
+    where = []
+    params = []
+    for column, op, value in parse_filter(query):
+        if known is not None and column not in known:
+            continue
+        if op == 'contains':
+            where.append('{} LIKE %s'.format(quote(column)))
+            params.append('%{}%'.format(value))
+        elif op == 'datestartswith':
+            where.append('{} LIKE %s'.format(quote(column)))
+            params.append('{}%'.format(value))
+        else:
+            where.append('{} {} %s'.format(quote(column), op))
+            params.append(value)
+    return where, params
+
+
+def where_filter(query, known=None):
+    ''' Translate a DataTable filter string into a WHERE clause and its params '''
+    where, params = filter_clauses(query, known)
+    return (' WHERE ' + ' AND '.join(where) if where else ''), params
+
+
+def read_page(table, page=0, page_size=50, sort_by=None, query=None, columns=None):
+    ''' Return one filtered, sorted page of a table and the number of matching rows '''
+    # the browser names the columns, so only ones the table has reach the SQL
+    known = table_columns(table)
+    columns = [c for c in columns or [] if c in known]
+    sort_by = [s for s in sort_by or [] if s['column_id'] in known]
+    where, params = where_filter(query, known)
+    total = read_query('SELECT COUNT(*) AS n FROM {}{}'.format(quote(table), where), params)['n'][0]
+    sql = 'SELECT {} FROM {}{}'.format(
+        ', '.join(quote(c) for c in columns) if columns else '*', quote(table), where)
+    if sort_by:
+        sql += ' ORDER BY ' + ', '.join(
+            '{} {}'.format(quote(s['column_id']), 'DESC' if s['direction'] == 'desc' else 'ASC')
+            for s in sort_by)
+    sql += ' LIMIT %s OFFSET %s'
+    df = read_query(sql, params + [page_size, page * page_size])
+    return df, int(total)
@@ -0,0 +1,144 @@
+''' Derived atmospheric quantities for whole flights
+
+Every field is computed with array operations over the flight:
+
+    hyps_alt    altitude from the hypsometric equation, integrating
+                dz = Rd / g * T * ln(p[i - 1] / p[i]) from the first sample
+                with T the mean of the two samples, referenced to the
+                first sample's GPS altitude
+    theta       potential temperature T * (P0 / p) ** (Rd / cp), in K
+    lapse_rate  environmental lapse rate -dT/dz in C/km, over a centred
+                window of LAPSE_WINDOW samples and NaN where the window
+                climbs less than MIN_DZ metres
+    vspeed      vertical speed in m/s, smoothed over SPEED_WINDOW samples
+    phase       1 ascending, -1 descending, 0 holding (|vspeed| < HOLD_SPEED),
+                with runs shorter than MIN_RUN samples merged into the run
+                before them
+    segment     number of the run of constant phase the sample belongs to
+
+Fields are computed over the samples that passed quality control (qa) and
+cached per flight next to the raw data in flight_cache.
+'''
+import numpy as np
+import pandas as pd
+
+from flightcache import flight_cache, flight_path, frame_nbytes
+import qa
+import tinv
+
+RD = 287.05
+CP = 1004.0
+G = 9.80665
+P0 = 1000.0
+KELVIN = 273.15
+
+LAPSE_WINDOW = 41
+MIN_DZ = 1.0
+SPEED_WINDOW = 21
+HOLD_SPEED = 0.2
+MIN_RUN = 40
+
+
+def _centred_mean(a, window):
+    ''' Moving mean over a centred window, shrinking at the ends '''
+    c = np.concatenate([[0.0], np.cumsum(a)])
+    half = window // 2
+    i = np.arange(len(a))
+    lo = np.maximum(i - half, 0)
+    hi = np.minimum(i + half + 1, len(a))
+    return (c[hi] - c[lo]) / (hi - lo)
+
+
+def hypsometric_altitude(press, temp, alt0=0.0):
+    ''' Return the altitude above the first sample implied by pressure and temperature '''
+    press = np.asarray(press, dtype='float64')
+    t = np.asarray(temp, dtype='float64') + KELVIN
+    dz = np.zeros(len(press))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dz[1:] = RD / G * 0.5 * (t[1:] + t[:-1]) * np.log(press[:-1] / press[1:])
+    return alt0 + np.cumsum(np.nan_to_num(dz))
+
+
+def potential_temperature(press, temp):
+    ''' Return the potential temperature in K of temperatures in C at pressures in hPa '''
+    return (np.asarray(temp, dtype='float64') + KELVIN) * \
+        (P0 / np.asarray(press, dtype='float64')) ** (RD / CP)
+
+
+def lapse_rate(alt, temp, window=LAPSE_WINDOW, min_dz=MIN_DZ):
+    ''' Return -dT/dz in C/km across a centred window of samples '''
+    alt = np.asarray(alt, dtype='float64')
+    temp = np.asarray(temp, dtype='float64')
+    half = window // 2
+    i = np.arange(len(alt))
+    lo = np.maximum(i - half, 0)
+    hi = np.minimum(i + half, len(alt) - 1)
+    dz = alt[hi] - alt[lo]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = -1000.0 * (temp[hi] - temp[lo]) / dz
+    rate[~(np.abs(dz) >= min_dz)] = np.nan
+    return rate
+
+
+def _merge_short_runs(phase, min_run):
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(phase)) + 1])
+    lengths = np.diff(np.concatenate([starts, [len(phase)]]))
+    # a short run takes the phase of the last long run before it
+    source = np.where(lengths >= min_run, np.arange(len(starts)), 0)
+    return np.repeat(phase[starts][np.maximum.accumulate(source)], lengths)
+
+
+def segments(times, alt, window=SPEED_WINDOW, hold_speed=HOLD_SPEED, min_run=MIN_RUN):
+    ''' Return the smoothed vertical speed, the ascent/descent phase and the segment number '''
+    seconds = (np.asarray(times).astype('datetime64[ns]').astype('int64')) / 1e9
+    alt = np.asarray(alt, dtype='float64')
+    speed = np.zeros(len(alt))
+    if len(alt) > 1:
+        dt = np.diff(seconds)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed[1:] = np.where(dt > 0, np.diff(alt) / dt, 0.0)
+        speed = _centred_mean(speed, window)
+    phase = np.sign(speed).astype('int8')
+    phase[np.abs(speed) < hold_speed] = 0
+    if len(phase):
+        phase = _merge_short_runs(phase, min_run)
+    segment = np.zeros(len(alt), dtype='int32')
+    segment[1:] = np.cumsum(phase[1:] != phase[:-1])
+    return speed, phase, segment
+
+
+def derive(df):
+    ''' Return the derived fields of a flight as a DataFrame aligned with it '''
+    temp = df['temp'].values
+    press = df['press'].values
+    alt = df['alt'].values
+    speed, phase, segment = segments(df['datetime'].values, alt)
+    return pd.DataFrame({
+        'datetime': df['datetime'].values,
+        'hyps_alt': hypsometric_altitude(press, temp, alt[0] if len(alt) else 0.0),
+        'theta': potential_temperature(press, temp),
+        'lapse_rate': lapse_rate(alt, temp),
+        'vspeed': speed,
+        'phase': phase,
+        'segment': segment,
+    }, columns=['datetime', 'hyps_alt', 'theta', 'lapse_rate', 'vspeed', 'phase', 'segment'])
+
+
+def load_derived(filename):
+    ''' Return the cached derived fields of a flight, aligned with qa.load_clean '''
+    return flight_cache.get(flight_path(filename),
+                            lambda path: derive(qa.load_clean(filename)),
+                            kind='derived', sizeof=frame_nbytes)
+
+
+def theta_profile(filename, bin_size=tinv.BIN_SIZE):
+    ''' Return (bins, mean potential temperature) of a flight binned like its TINV profile '''
+    def loader(path):
+        df = qa.load_clean(filename)
+        profile = tinv.profile_from_sums(*tinv.bin_sums(df['alt'].values,
+                                                        load_derived(filename)['theta'].values,
+                                                        bin_size), bin_size=bin_size)
+        return profile.bins, profile.temp
+
+    return flight_cache.get(flight_path(filename), loader, kind=('theta', bin_size),
+                            sizeof=lambda p: p[0].nbytes + p[1].nbytes)
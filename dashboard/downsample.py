@@ -0,0 +1,102 @@
+''' Server-side downsampling of time series before they are sent to the browser
+
+minmax keeps the lowest and highest sample of every bucket, so spikes survive,
+and is fully vectorized. lttb (Largest-Triangle-Three-Buckets) keeps the
+visually most significant point per bucket at the cost of one short loop per
+bucket.
+'''
+import numpy as np
+import pandas as pd
+
+MAX_POINTS = 2000
+
+
+def _as_float(x):
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        return x.astype('datetime64[ns]').view('int64').astype('float64')
+    return x.astype('float64')
+
+
+def minmax_indices(y, max_points=MAX_POINTS):
+    ''' Return sorted indices of the min and max sample of max_points // 2 buckets '''
+    y = np.asarray(y, dtype='float64')
+    n = len(y)
+    if n <= max_points:
+        return np.arange(n)
+    buckets = max(1, max_points // 2)
+    size = -(-n // buckets)
+    padded = np.full(buckets * size, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(buckets, size)
+    full = ~np.all(np.isnan(padded), axis=1)
+    offsets = np.arange(buckets)[full] * size
+    filled = np.where(np.isnan(padded[full]), np.inf, padded[full])
+    lo = offsets + np.argmin(filled, axis=1)
+    filled = np.where(np.isnan(padded[full]), -np.inf, padded[full])
+    hi = offsets + np.argmax(filled, axis=1)
+    return np.unique(np.concatenate([lo, hi, [0, n - 1]]))
+
+
+def lttb_indices(x, y, max_points=MAX_POINTS):
+    ''' Return indices of the points Largest-Triangle-Three-Buckets keeps '''
+    x = _as_float(x)
+    y = np.asarray(y, dtype='float64')
+    n = len(y)
+    if n <= max_points or max_points < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, max_points - 1).astype('int64')
+    keep = np.empty(max_points, dtype='int64')
+    keep[0] = 0
+    keep[-1] = n - 1
+    a = 0
+    for b in range(max_points - 2):
+        start, stop = edges[b], edges[b + 1]
+        if b + 2 < len(edges):
+            nstart, nstop = edges[b + 1], edges[b + 2]
+            cx = x[nstart:nstop].mean()
+            cy = y[nstart:nstop].mean()
+        else:
+            cx, cy = x[n - 1], y[n - 1]
+        area = np.abs((x[a] - cx) * (y[start:stop] - y[a])
+                      - (x[a] - x[start:stop]) * (cy - y[a]))
+        a = start + int(np.nanargmax(area)) if np.isfinite(area).any() else start
+        keep[b + 1] = a
+    return keep
+
+
+def downsample(x, y, max_points=MAX_POINTS, method='minmax'):
+    ''' Return x and y reduced to at most about max_points samples
+
+    Datetime x comes back as a DatetimeIndex, which plotly serialises as dates
+    rather than as the integers of a raw datetime64 array.
+    '''
+    if method == 'lttb':
+        keep = lttb_indices(x, y, max_points)
+    else:
+        keep = minmax_indices(y, max_points)
+    x = np.asarray(x)[keep]
+    if np.issubdtype(x.dtype, np.datetime64):
+        x = pd.DatetimeIndex(x)
+    return x, np.asarray(y)[keep]
+
+
+def zoom_window(relayout):
+    ''' Return the (start, end) x-range of a graph's relayoutData, or None when unzoomed '''
+    if not relayout or relayout.get('xaxis.autorange'):
+        return None
+    if 'xaxis.range[0]' in relayout and 'xaxis.range[1]' in relayout:
+        start, end = relayout['xaxis.range[0]'], relayout['xaxis.range[1]']
+    elif 'xaxis.range' in relayout:
+        start, end = relayout['xaxis.range']
+    else:
+        return None
+    return pd.Timestamp(start), pd.Timestamp(end)
+
+
+def window(df, start, end, column='datetime'):
+    ''' Return the rows of a frame sorted by column that fall inside [start, end] '''
+    values = df[column].values
+    lo = np.searchsorted(values, pd.Timestamp(start).to_datetime64(), side='left')
+    hi = np.searchsorted(values, pd.Timestamp(end).to_datetime64(), side='right')
+    return df.iloc[lo:hi]
@@ -0,0 +1,104 @@
+import os
+import threading
+from collections import OrderedDict
+
+import flightstore
+from metrics import phase
+
+pathway = '../data/balloon/'
+
+
+def frame_nbytes(df):
+    ''' Approximate in-memory size of a DataFrame in bytes '''
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+class FlightCache(object):
+    ''' Process-wide LRU cache of parsed flights
+
+    Entries are keyed by (path, kind) and remember the mtime of the source
+    file they were built from, so a rewritten flight is reloaded on the next
+    access. A flight's kinds (raw, qa, clean, derived, ...) are kept and
+    evicted together, so max_entries counts flights rather than entries, and
+    one sweep over the flights cannot push out the kinds it is about to use.
+    The cache is also bounded by total bytes.
+    '''
+
+    def __init__(self, max_entries=16, max_bytes=512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # path -> {kind: (value, mtime, size)}, least recently used path first
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, path, loader, kind='raw', sizeof=frame_nbytes):
+        ''' Return loader(path), reusing the cached result while the file is unchanged '''
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            kinds = self._entries.get(path)
+            entry = kinds.get(kind) if kinds is not None else None
+            if entry is not None and entry[1] == mtime:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        with phase('load'):
+            value = loader(path)
+        size = sizeof(value)
+
+        with self._lock:
+            self._discard(path, kind)
+            if size <= self.max_bytes:
+                self._entries.setdefault(path, {})[kind] = (value, mtime, size)
+                self._entries.move_to_end(path)
+                self.nbytes += size
+                self._evict()
+        return value
+
+    def invalidate(self, path=None):
+        ''' Drop every entry for path, or the whole cache when path is None '''
+        with self._lock:
+            for key in list(self._entries) if path is None else [path]:
+                for kind in list(self._entries.get(key, ())):
+                    self._discard(key, kind)
+
+    def _discard(self, path, kind):
+        kinds = self._entries.get(path)
+        if kinds is None or kind not in kinds:
+            return
+        self.nbytes -= kinds.pop(kind)[2]
+        if not kinds:
+            del self._entries[path]
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries
+                                 or self.nbytes > self.max_bytes):
+            path = next(iter(self._entries))
+            kinds = self._entries[path]
+            # past the byte bound a single flight gives up its kinds oldest first
+            self._discard(path, next(iter(kinds)))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+flight_cache = FlightCache()
+
+
+def flight_path(filename):
+    ''' Return the path of a file in the balloon data directory '''
+    # pathway is looked up per call, so it can be pointed elsewhere after import
+    return os.path.join(pathway, filename)
+
+
+def load_flight(filename):
+    ''' Return the memory-mapped flight for a file in the balloon data directory
+
+    The returned DataFrame is shared between callbacks and must not be
+    modified in place.
+    '''
+    return flight_cache.get(flight_path(filename), flightstore.load_flight)
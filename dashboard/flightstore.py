@@ -0,0 +1,138 @@
+''' Columnar binary store for balloon flights
+
+A flight file is laid out as
+
+    header   magic 'PCFL', version, column count, row count   (16 bytes)
+    columns  one 16-byte descriptor per column (name, dtype)
+    padding  up to a 64-byte boundary
+    datetime int64 nanoseconds since the epoch, nrows values
+    values   float32 block of shape (len(FLOAT_COLUMNS), nrows)
+
+The float columns are stored as one C-contiguous block so pandas can wrap the
+memory map as a single float32 block without copying it.
+
+Frames derived from a flight with the same columns, such as its samples that
+pass quality control, are stored the same way as named views next to it
+(<flight>.<view>.pcf), so every process maps them instead of holding a copy.
+
+Usage: python flightstore.py [--src ../data/balloon] [--dst ../data/store]
+'''
+import argparse
+import os
+import struct
+
+import numpy as np
+import pandas as pd
+
+MAGIC = b'PCFL'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQ')
+COLUMN = struct.Struct('<8s2s6x')
+ALIGN = 64
+
+FLOAT_COLUMNS = ['temp', 'press', 'alt']
+
+storeway = '../data/store/'
+
+
+def store_path(csv_path, dst=None, view=None):
+    # resolved per call, so storeway can be pointed elsewhere after import
+    dst = storeway if dst is None else dst
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    if view is not None:
+        name += '.' + view
+    return os.path.join(dst, name + '.pcf')
+
+
+def _data_offset(ncols):
+    size = HEADER.size + COLUMN.size * ncols
+    return (size + ALIGN - 1) // ALIGN * ALIGN
+
+
+def write_flight(df, path):
+    ''' Write a flight DataFrame to path in the columnar binary format '''
+    nrows = len(df)
+    stamps = pd.to_datetime(df['datetime']).values.astype('datetime64[ns]').view('int64')
+    block = np.empty((len(FLOAT_COLUMNS), nrows), dtype='<f4')
+    for i, column in enumerate(FLOAT_COLUMNS):
+        block[i] = df[column].values
+
+    header = HEADER.pack(MAGIC, VERSION, 1 + len(FLOAT_COLUMNS), nrows)
+    header += COLUMN.pack(b'datetime', b'i8')
+    for column in FLOAT_COLUMNS:
+        header += COLUMN.pack(column.encode(), b'f4')
+    header = header.ljust(_data_offset(1 + len(FLOAT_COLUMNS)), b'\0')
+
+    # write next to the target and rename so readers never see a partial file
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(header)
+        f.write(np.ascontiguousarray(stamps, dtype='<i8').tobytes())
+        f.write(block.tobytes())
+    os.replace(tmp, path)
+
+
+def open_flight(path):
+    ''' Memory-map a stored flight and return a read-only DataFrame over it '''
+    buf = np.memmap(path, dtype='u1', mode='r')
+    magic, version, ncols, nrows = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('{} is not a flight store file'.format(path))
+    names = []
+    for i in range(ncols):
+        name, dtype = COLUMN.unpack_from(buf, HEADER.size + COLUMN.size * i)
+        names.append(name.rstrip(b'\0').decode())
+    if names != ['datetime'] + FLOAT_COLUMNS:
+        raise ValueError('{} has unexpected columns {}'.format(path, names))
+
+    offset = _data_offset(ncols)
+    stamps = np.frombuffer(buf, dtype='<i8', count=nrows, offset=offset)
+    offset += stamps.nbytes
+    block = np.frombuffer(buf, dtype='<f4', count=nrows * len(FLOAT_COLUMNS),
+                          offset=offset).reshape(len(FLOAT_COLUMNS), nrows)
+
+    df = pd.DataFrame(block.T, columns=FLOAT_COLUMNS, copy=False)
+    df.insert(0, 'datetime', stamps.view('datetime64[ns]'))
+    return df
+
+
+def ingest(csv_path, dst=None):
+    ''' Convert one flight CSV into the store and return the store path '''
+    dst = storeway if dst is None else dst
+    df = pd.read_csv(csv_path, sep=',', parse_dates=['datetime'],
+                     dtype={column: 'float32' for column in FLOAT_COLUMNS})
+    if not os.path.isdir(dst):
+        os.makedirs(dst)
+    path = store_path(csv_path, dst)
+    write_flight(df, path)
+    return path
+
+
+def load_flight(csv_path, dst=None):
+    ''' Return a flight from the store, ingesting the CSV first when the store is stale '''
+    path = store_path(csv_path, dst)
+    if not os.path.isfile(path) or os.path.getmtime(path) < os.path.getmtime(csv_path):
+        path = ingest(csv_path, dst)
+    return open_flight(path)
+
+
+def load_view(csv_path, view, build, dst=None):
+    ''' Return a stored view of a flight, writing build() to the store first when the CSV changed '''
+    path = store_path(csv_path, dst, view)
+    if not os.path.isfile(path) or os.path.getmtime(path) < os.path.getmtime(csv_path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        write_flight(build(), path)
+    return open_flight(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert balloon flight CSVs to the columnar store')
+    parser.add_argument('--src', default='../data/balloon/')
+    parser.add_argument('--dst', default=None)
+    args = parser.parse_args()
+
+    for f in sorted(os.listdir(args.src)):
+        if f.endswith('.csv'):
+            print(ingest(os.path.join(args.src, f), args.dst))
@@ -0,0 +1,116 @@
+''' Interpolated maps of station pollution over Bangkok
+
+Station values are spread onto a regular lat/long grid by inverse distance
+weighting over each cell's NEIGHBOURS nearest stations. The weights depend
+only on the grid and the station list, so they are built once as a
+(cells, stations) matrix from one broadcast haversine kernel. A map for an
+hour is then a single matrix product. Stations without a value that hour
+drop out, and the remaining weights are renormalised.
+
+Maps are cached per (param, hour) and keyed on a digest of that hour's
+station values, so an hour is only recomputed when a sync has changed its
+own values, not whenever its month partition is rewritten.
+'''
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from metrics import phase
+from stations import get_index, haversine
+import warehouse
+
+BOUNDS = (13.45, 14.15, 100.25, 101.0)
+GRID_SIZE = 80
+NEIGHBOURS = 8
+POWER = 2.0
+MAX_GRIDS = 24 * 3 * 7
+
+
+class GridCache(object):
+    ''' LRU cache of interpolated grids, keyed by param, hour and the hour's values '''
+
+    def __init__(self, max_entries=MAX_GRIDS):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        ''' Return loader(), reusing the grid cached under key '''
+        with self._lock:
+            grid = self._entries.get(key)
+            if grid is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return grid
+            self.misses += 1
+        with phase('load'):
+            grid = loader()
+        with self._lock:
+            self._entries[key] = grid
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return grid
+
+    def __len__(self):
+        return len(self._entries)
+
+
+grid_cache = GridCache()
+
+_weights = None
+
+
+def grid_axes():
+    ''' Return the latitudes and longitudes of the grid rows and columns '''
+    lat0, lat1, long0, long1 = BOUNDS
+    return np.linspace(lat0, lat1, GRID_SIZE), np.linspace(long0, long1, GRID_SIZE)
+
+
+def idw_weights(grid_lat, grid_long, lat, long, neighbours=NEIGHBOURS, power=POWER):
+    ''' Return the (cells, stations) IDW weights of each cell's nearest stations '''
+    dist = haversine(grid_lat[:, np.newaxis], grid_long[:, np.newaxis],
+                     lat[np.newaxis, :], long[np.newaxis, :])
+    k = min(neighbours, dist.shape[1])
+    nearest = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    rows = np.arange(dist.shape[0])[:, np.newaxis]
+    weights = np.zeros_like(dist)
+    # a cell on top of a station takes its value
+    weights[rows, nearest] = 1.0 / np.maximum(dist[rows, nearest], 1e-3) ** power
+    return weights
+
+
+def get_weights():
+    ''' Return the station ids and weights for the grid, building them on first use '''
+    global _weights
+    if _weights is None:
+        index = get_index()
+        lats, longs = grid_axes()
+        grid_lat, grid_long = np.meshgrid(lats, longs, indexing='ij')
+        _weights = (list(index.stations['stationID']),
+                    idw_weights(grid_lat.ravel(), grid_long.ravel(), index.lat, index.long))
+    return _weights
+
+
+def interpolate(weights, values):
+    ''' Return weights @ values, ignoring missing values; values is (stations,) or (stations, hours) '''
+    values = np.asarray(values, dtype='float64')
+    present = np.isfinite(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return weights.dot(np.where(present, values, 0.0)) / weights.dot(present)
+
+
+def hour_map(param, hour):
+    ''' Return the interpolated (lat, long) grid of a param at an hour, NaN where no station reports '''
+    hour = pd.Timestamp(hour).floor('60min')
+    ids, weights = get_weights()
+    # one column of a memory-mapped partition, so reading it is cheap
+    _, _, values = warehouse.read_range(param, hour, hour, ids)
+    column = np.ascontiguousarray(values[:, 0])
+    key = (param, str(hour), hashlib.sha1(column.tobytes()).hexdigest())
+    return grid_cache.get(key, lambda: interpolate(weights, column)
+                          .reshape(GRID_SIZE, GRID_SIZE).astype('float32'))
@@ -0,0 +1,149 @@
+''' Background jobs for slow callbacks, with results kept in SQLite
+
+A job is identified by its function name and arguments. submit() inserts
+a 'running' row for the key, and only the process whose insert wins runs
+the job, on a small per-process thread pool. Identical requests, from any
+gunicorn worker, are deduplicated against that row. The pickled result or
+the error is written back to the row, where result() finds it.
+
+background() turns a callback into a start callback, which submits the
+job and returns its key to a dcc.Store, and a poll callback. The poll
+callback is driven by a dcc.Interval until the result is ready. Neither
+one blocks a worker for longer than a SQLite lookup. Put components(name)
+in the layout for every background callback.
+
+A finished result is reused for ttl seconds, RESULT_TTL by default; a job
+over data that may still change (e.g. today's station readings) should pass
+that data's freshness instead. Job bodies are timed in metrics under the
+callback's own name.
+'''
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dash
+import dash_core_components as dcc
+from dash.dependencies import Input, Output
+from dash.exceptions import PreventUpdate
+
+from metrics import run_timed
+
+jobway = '../cache/jobs.sqlite'
+
+MAX_WORKERS = 4
+POLL_INTERVAL = 500
+RESULT_TTL = 10 * 60
+# a running row this old belongs to a worker that died
+STALE_AFTER = 10 * 60
+
+RUNNING = 'running'
+DONE = 'done'
+ERROR = 'error'
+
+_db = None
+_db_pid = None
+_executor = None
+_lock = threading.Lock()
+
+
+def _connect():
+    # connections and pools must not cross a fork, so both are per process
+    global _db, _db_pid, _executor
+    if _db is None or _db_pid != os.getpid():
+        directory = os.path.dirname(jobway)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        _db = sqlite3.connect(jobway, timeout=30, check_same_thread=False,
+                              isolation_level=None)
+        _db.execute('PRAGMA journal_mode=WAL')
+        _db.execute('CREATE TABLE IF NOT EXISTS jobs (key TEXT PRIMARY KEY, status TEXT, '
+                    'result BLOB, error TEXT, started REAL, finished REAL)')
+        _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        _db_pid = os.getpid()
+    return _db
+
+
+def job_key(name, args):
+    text = json.dumps([name, list(args)], sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def _run(key, func, args):
+    try:
+        row = (DONE, pickle.dumps(run_timed(func, *args), pickle.HIGHEST_PROTOCOL), None)
+    except Exception as e:
+        row = (ERROR, None, repr(e))
+    with _lock:
+        _connect().execute('UPDATE jobs SET status = ?, result = ?, error = ?, finished = ? '
+                           'WHERE key = ?', row + (time.time(), key))
+
+
+def submit(func, *args, **kwargs):
+    ''' Start func(*args) unless the same job is running or finished within ttl; return its key '''
+    ttl = kwargs.get('ttl', RESULT_TTL)
+    key = job_key(func.__name__, args)
+    now = time.time()
+    with _lock:
+        db = _connect()
+        db.execute('DELETE FROM jobs WHERE (status != ? AND finished < ?) '
+                   'OR (status = ? AND started < ?) '
+                   'OR (key = ? AND (status = ? OR finished < ?))',
+                   (RUNNING, now - RESULT_TTL, RUNNING, now - STALE_AFTER, key, ERROR, now - ttl))
+        inserted = db.execute('INSERT OR IGNORE INTO jobs (key, status, started) VALUES (?, ?, ?)',
+                              (key, RUNNING, now)).rowcount
+        if inserted:
+            _executor.submit(_run, key, func, args)
+    return key
+
+
+def result(key):
+    ''' Return (status, value) of a job; value is the error text for failed jobs '''
+    with _lock:
+        row = _connect().execute('SELECT status, result, error FROM jobs WHERE key = ?',
+                                 (key,)).fetchone()
+    if row is None:
+        return None, None
+    status, blob, error = row
+    if status == DONE:
+        return status, pickle.loads(blob)
+    return status, error
+
+
+def components(name):
+    ''' Return the store and interval a background callback called name needs in the layout '''
+    return [dcc.Store(id='{}-job'.format(name)),
+            dcc.Interval(id='{}-poll'.format(name), interval=POLL_INTERVAL, disabled=True)]
+
+
+def background(app, name, output, inputs, state=(), ttl=RESULT_TTL):
+    ''' Register a callback that computes output in a background job '''
+    outputs = output if isinstance(output, list) else [output]
+
+    def decorate(func):
+        def start(*args):
+            return {'key': submit(func, *args, ttl=ttl)}
+        start.__name__ = 'start_' + func.__name__
+        app.callback(Output('{}-job'.format(name), 'data'), inputs, list(state))(start)
+
+        def poll(job, n_intervals):
+            if not job:
+                raise PreventUpdate
+            status, value = result(job['key'])
+            if status == RUNNING:
+                return [dash.no_update] * len(outputs) + [False]
+            if status != DONE:
+                # a lost or failed job; the next change of inputs submits it again
+                return [dash.no_update] * len(outputs) + [True]
+            values = list(value) if isinstance(output, list) else [value]
+            return values + [True]
+        poll.__name__ = 'poll_' + func.__name__
+        app.callback(outputs + [Output('{}-poll'.format(name), 'disabled')],
+                     [Input('{}-job'.format(name), 'data'),
+                      Input('{}-poll'.format(name), 'n_intervals')])(poll)
+        return func
+    return decorate
@@ -0,0 +1,122 @@
+''' Live telemetry: tail a balloon CSV that is still being written
+
+A LiveFlight scans the file once, then on every poll reads only the bytes
+appended since its last offset. It keeps the byte offset at which every row
+ends, so a client that has already drawn n rows can be sent just rows n and
+later, and it keeps running TINV bin sums so the inversion profile is
+updated without re-reading the file. Rows go through the same quality
+control as whole flights (qa.StreamingQA); flagged rows are kept in the row
+count but left out of the bin sums and of the rows returned by rows_since.
+Blank lines are not rows: they are dropped before quality control and get no
+entry in the row ends.
+'''
+import io
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+import qa
+import tinv
+
+CHUNK = 4 * 1024 * 1024
+
+
+class LiveFlight(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.bins = tinv.BinAccumulator()
+        self.qa = qa.StreamingQA()
+        self._lock = threading.Lock()
+        with open(path, 'rb') as f:
+            header = f.readline()
+        self.columns = header.decode().strip().split(',')
+        self.start = self.offset = len(header)
+        self._ends = np.zeros(1024, dtype='int64')
+        self._good = np.zeros(1024, dtype=bool)
+        self.rows = 0
+        self.poll()
+
+    def _parse(self, data):
+        ''' Parse complete lines; return the rows and which of the lines held one '''
+        # one parsed row per line, so blank lines can be matched to their newline
+        df = pd.read_csv(io.BytesIO(data), header=None, names=self.columns,
+                         skip_blank_lines=False)
+        kept = df.notna().any(axis=1).values
+        if not kept.all():
+            df = df[kept].reset_index(drop=True)
+        df['datetime'] = pd.to_datetime(df['datetime'])
+        return df, kept
+
+    def _append_rows(self, ends, good):
+        if self.rows + len(ends) > len(self._ends):
+            size = max(self.rows + len(ends), 2 * len(self._ends))
+            self._ends = np.concatenate([self._ends, np.zeros(size - len(self._ends), dtype='int64')])
+            self._good = np.concatenate([self._good, np.zeros(size - len(self._good), dtype=bool)])
+        self._ends[self.rows:self.rows + len(ends)] = ends
+        self._good[self.rows:self.rows + len(ends)] = good
+        self.rows += len(ends)
+
+    def poll(self):
+        ''' Consume complete rows appended since the last poll and return them '''
+        with self._lock:
+            if os.path.getsize(self.path) <= self.offset:
+                return pd.DataFrame(columns=self.columns)
+            frames = []
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                while True:
+                    data = f.read(CHUNK)
+                    cut = data.rfind(b'\n') + 1
+                    if cut == 0:
+                        break
+                    data = data[:cut]
+                    newlines = np.flatnonzero(np.frombuffer(data, dtype='u1') == ord('\n'))
+                    df, kept = self._parse(data)
+                    good = self.qa.update(df)
+                    self._append_rows(self.offset + newlines[kept] + 1, good)
+                    self.bins.add(df['alt'].values[good], df['temp'].values[good])
+                    frames.append(df)
+                    self.offset += cut
+                    f.seek(self.offset)
+            if not frames:
+                return pd.DataFrame(columns=self.columns)
+            return pd.concat(frames, ignore_index=True)
+
+    def rows_since(self, seen):
+        ''' Poll, then return every good row after the first seen rows and the new row count '''
+        new = self.poll()
+        with self._lock:
+            rows = self.rows
+            good = self._good[seen:rows]
+            if seen == rows - len(new):
+                return new[good], rows
+            if seen >= rows:
+                return new.iloc[:0], rows
+            start = self._ends[seen - 1] if seen > 0 else self.start
+            end = self._ends[rows - 1]
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start)
+        return self._parse(data)[0][good], rows
+
+    def profile(self):
+        ''' Poll, then return the TINV profile of every row so far '''
+        self.poll()
+        with self._lock:
+            return self.bins.profile()
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def get_flight(path):
+    ''' Return this process's LiveFlight for path, starting it on first use '''
+    with _flights_lock:
+        flight = _flights.get(path)
+        if flight is None:
+            flight = _flights[path] = LiveFlight(path)
+        return flight
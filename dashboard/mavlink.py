@@ -0,0 +1,145 @@
+''' Streaming parser for comma-separated MAVLink telemetry logs
+
+A log is scanned once in fixed-size chunks to build an index of the byte
+offsets of every line, grouped by the mavlink_*_t message type it carries.
+Reading a message type afterwards touches only the indexed lines and decodes
+just the requested columns into typed arrays, one chunk at a time, so memory
+stays bounded by the chunk size plus the result.
+
+Indexes and decoded messages are cached per file and rebuilt when its mtime
+changes.
+'''
+import io
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from flightcache import flight_cache
+
+CHUNK = 16 * 1024 * 1024
+MESSAGE = re.compile(rb'mavlink_\w+?_t\b')
+
+# column positions of the fields we read from each known message type
+MESSAGES = {
+    'mavlink_scaled_pressure_t': {
+        'datetime': 0,
+        'press_abs': 13,
+        'press_diff': 15,
+        'temperature': 17,
+    },
+}
+
+
+def _chunks(f, size=CHUNK):
+    ''' Yield (offset, bytes) of whole lines read from f in roughly size-byte chunks '''
+    offset = 0
+    rest = b''
+    while True:
+        data = f.read(size)
+        if not data:
+            if rest:
+                yield offset, rest
+            return
+        data = rest + data
+        cut = data.rfind(b'\n') + 1
+        if cut == 0:
+            rest = data
+            continue
+        yield offset, data[:cut]
+        offset += cut
+        rest = data[cut:]
+
+
+def build_index(path):
+    ''' Return {message type: (starts, ends)} byte ranges of every line of each type '''
+    found = {}
+    with open(path, 'rb') as f:
+        for offset, data in _chunks(f):
+            newlines = np.flatnonzero(np.frombuffer(data, dtype='u1') == ord('\n'))
+            positions = {}
+            for match in MESSAGE.finditer(data):
+                positions.setdefault(match.group().decode(), []).append(match.start())
+            for name, pos in positions.items():
+                lines = np.unique(np.searchsorted(newlines, pos))
+                starts = np.zeros(len(lines), dtype='int64')
+                starts[lines > 0] = newlines[lines[lines > 0] - 1] + 1
+                ends = np.full(len(lines), len(data), dtype='int64')
+                ends[lines < len(newlines)] = newlines[lines[lines < len(newlines)]]
+                found.setdefault(name, []).append((offset + starts, offset + ends))
+    return {name: (np.concatenate([s for s, e in spans]), np.concatenate([e for s, e in spans]))
+            for name, spans in found.items()}
+
+
+def _index_nbytes(index):
+    return sum(starts.nbytes + ends.nbytes for starts, ends in index.values())
+
+
+def get_index(path):
+    ''' Return the cached line index of a log '''
+    return flight_cache.get(path, build_index, kind='mavlink-index', sizeof=_index_nbytes)
+
+
+def message_types(path):
+    ''' Return {message type: line count} for a log '''
+    return {name: len(starts) for name, (starts, ends) in get_index(path).items()}
+
+
+def _find_columns(line, fields):
+    # logs written as name,value pairs: a field's value follows its name
+    tokens = [t.strip() for t in line.split(',')]
+    return {field: tokens.index(field) + 1 for field in fields}
+
+
+def read_message(path, message, fields=None):
+    ''' Decode one message type of a log into a DataFrame of typed columns
+
+    fields maps column names to their position in the line. It defaults to
+    MESSAGES[message]; given as a list of names instead, each value is taken
+    from the column after the matching name in the first line.
+    '''
+    starts, ends = get_index(path).get(message, (np.array([], dtype='int64'),) * 2)
+    if fields is None:
+        fields = MESSAGES[message]
+
+    frames = []
+    with open(path, 'rb') as f:
+        lo = 0
+        while lo < len(starts):
+            # gather the lines of this message that fit in the next chunk
+            hi = np.searchsorted(starts, starts[lo] + CHUNK, side='left')
+            hi = max(hi, lo + 1)
+            f.seek(starts[lo])
+            data = f.read(ends[hi - 1] - starts[lo])
+            base = starts[lo]
+            lines = b'\n'.join(data[s - base:e - base] for s, e in zip(starts[lo:hi], ends[lo:hi]))
+            if not isinstance(fields, dict):
+                fields = _find_columns(lines.split(b'\n', 1)[0].decode(), fields)
+
+            dtypes = {column: 'str' if name == 'datetime' else 'float64'
+                      for name, column in fields.items()}
+            chunk = pd.read_csv(io.BytesIO(lines), header=None, usecols=list(fields.values()),
+                                dtype=dtypes, skipinitialspace=True)
+            chunk = chunk.rename(columns={column: name for name, column in fields.items()})
+            if 'datetime' in chunk:
+                chunk['datetime'] = pd.to_datetime(chunk['datetime'])
+            frames.append(chunk)
+            lo = hi
+
+    if not frames:
+        return pd.DataFrame(columns=list(fields))
+    df = pd.concat(frames, ignore_index=True)
+    return df[list(fields)]
+
+
+def load_message(path, message, fields=None):
+    ''' Return the cached decoded message type of a log '''
+    key = tuple(sorted(fields.items())) if isinstance(fields, dict) else tuple(fields or ())
+    return flight_cache.get(path, lambda p: read_message(p, message, fields),
+                            kind=('mavlink', message, key))
+
+
+def load_scaled_pressure(filename, pathway='../data/'):
+    ''' Return the scaled pressure messages of a log in the data directory '''
+    return load_message(os.path.join(pathway, filename), 'mavlink_scaled_pressure_t')
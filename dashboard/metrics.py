@@ -0,0 +1,250 @@
+''' Per-callback timing, cache counters and a Prometheus /metrics route
+
+instrument(app) wraps every callback registered on the app afterwards. Each
+call is split into three phases:
+
+    load       time spent inside phase('load') blocks (flight loads, API fetches)
+    compute    the rest of the callback body
+    serialize  from the callback returning to the response leaving Flask
+
+along with the response payload size. Callbacks run as background jobs
+(see jobs) are recorded with run_timed, under their own name, with no
+serialize phase or payload. Counters live in the worker process, so with
+several gunicorn workers each scrape sees the worker that served it.
+
+GET /metrics/profile?callback=update_tinv arms a sampling profiler for the
+next call of that callback in this worker; GET /metrics/profile afterwards
+returns its stacks in folded format, ready for flamegraph.pl. The profile
+routes ask for the app's login when instrument() is given its BasicAuth;
+/metrics itself stays open to the scraper.
+'''
+import math
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+import flask
+from dash.exceptions import PreventUpdate
+
+PHASES = ('load', 'compute', 'serialize')
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROFILE_INTERVAL = 0.005
+PROFILE_INTERVALS = (0.001, 1.0)
+
+_local = threading.local()
+_lock = threading.Lock()
+_calls = Counter()
+_errors = Counter()
+_seconds = defaultdict(float)
+_payload = Counter()
+_histogram = defaultdict(Counter)
+_caches = {}
+
+_profile_armed = {}
+_profile_result = {'callback': None, 'stacks': Counter()}
+_auth = None
+
+
+@contextmanager
+def phase(name):
+    ''' Attribute the time spent in the block to a phase of the running callback '''
+    record = getattr(_local, 'record', None)
+    if record is None or record.get('in_phase'):
+        yield
+        return
+    record['in_phase'] = True
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record[name] = record.get(name, 0.0) + time.perf_counter() - start
+        record['in_phase'] = False
+
+
+def register_cache(name, cache):
+    ''' Export the hits and misses attributes of a cache object '''
+    _caches[name] = cache
+
+
+class Sampler(threading.Thread):
+    ''' Samples the stack of one thread at a fixed interval '''
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        threading.Thread.__init__(self, name='metrics-sampler')
+        self.daemon = True
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = ['{}:{}'.format(f.name, f.lineno) for f in traceback.extract_stack(frame)]
+            self.stacks[';'.join(stack)] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.stacks
+
+
+def timed(func):
+    ''' Wrap a callback so its load and compute phases are recorded '''
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        record = {'callback': name}
+        _local.record = record
+        sampler = None
+        interval = _profile_armed.pop(name, None)
+        if interval is not None:
+            sampler = Sampler(threading.current_thread().ident, interval)
+            sampler.start()
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except PreventUpdate:
+            raise
+        except Exception:
+            with _lock:
+                _errors[name] += 1
+            raise
+        finally:
+            record['total'] = time.perf_counter() - start
+            record['returned'] = time.perf_counter()
+            if sampler is not None:
+                _profile_result['callback'] = name
+                _profile_result['stacks'] = sampler.stop()
+
+    return wrapper
+
+
+def _record(record, serialize, payload):
+    name = record['callback']
+    load = record.get('load', 0.0)
+    total = record['total'] + serialize
+    with _lock:
+        _calls[name] += 1
+        _seconds[name, 'load'] += load
+        _seconds[name, 'compute'] += record['total'] - load
+        _seconds[name, 'serialize'] += serialize
+        _payload[name] += payload
+        for bucket in BUCKETS:
+            if total <= bucket:
+                _histogram[name][bucket] += 1
+
+
+def _finish(response):
+    record = getattr(_local, 'record', None)
+    _local.record = None
+    if record is None or 'total' not in record:
+        return response
+    _record(record, time.perf_counter() - record['returned'],
+            response.calculate_content_length() or 0)
+    return response
+
+
+def run_timed(func, *args):
+    ''' Call func(*args) outside a request, recording it like a callback '''
+    try:
+        return timed(func)(*args)
+    finally:
+        record = getattr(_local, 'record', None)
+        _local.record = None
+        if record is not None and 'total' in record:
+            _record(record, 0.0, 0)
+
+
+def render():
+    ''' Return every metric in the Prometheus text exposition format '''
+    lines = []
+    with _lock:
+        lines.append('# HELP dash_callback_calls_total Completed callback requests.')
+        lines.append('# TYPE dash_callback_calls_total counter')
+        for name in sorted(_calls):
+            lines.append('dash_callback_calls_total{{callback="{}"}} {}'.format(name, _calls[name]))
+        lines.append('# HELP dash_callback_errors_total Callbacks that raised.')
+        lines.append('# TYPE dash_callback_errors_total counter')
+        for name in sorted(_errors):
+            lines.append('dash_callback_errors_total{{callback="{}"}} {}'.format(name, _errors[name]))
+        lines.append('# HELP dash_callback_phase_seconds_total Wall time per callback phase.')
+        lines.append('# TYPE dash_callback_phase_seconds_total counter')
+        for name in sorted(_calls):
+            for p in PHASES:
+                lines.append('dash_callback_phase_seconds_total{{callback="{}",phase="{}"}} {:.6f}'
+                             .format(name, p, _seconds[name, p]))
+        lines.append('# HELP dash_callback_payload_bytes_total Response bytes sent per callback.')
+        lines.append('# TYPE dash_callback_payload_bytes_total counter')
+        for name in sorted(_calls):
+            lines.append('dash_callback_payload_bytes_total{{callback="{}"}} {}'.format(name, _payload[name]))
+        lines.append('# HELP dash_callback_seconds Callback wall time including serialization.')
+        lines.append('# TYPE dash_callback_seconds histogram')
+        for name in sorted(_calls):
+            for bucket in BUCKETS:
+                lines.append('dash_callback_seconds_bucket{{callback="{}",le="{}"}} {}'
+                             .format(name, bucket, _histogram[name][bucket]))
+            lines.append('dash_callback_seconds_bucket{{callback="{}",le="+Inf"}} {}'
+                         .format(name, _calls[name]))
+            lines.append('dash_callback_seconds_sum{{callback="{}"}} {:.6f}'
+                         .format(name, sum(_seconds[name, p] for p in PHASES)))
+            lines.append('dash_callback_seconds_count{{callback="{}"}} {}'.format(name, _calls[name]))
+    lines.append('# HELP cache_hits_total Cache lookups served from the cache.')
+    lines.append('# TYPE cache_hits_total counter')
+    for name in sorted(_caches):
+        lines.append('cache_hits_total{{cache="{}"}} {}'.format(name, _caches[name].hits))
+    lines.append('# HELP cache_misses_total Cache lookups that had to load.')
+    lines.append('# TYPE cache_misses_total counter')
+    for name in sorted(_caches):
+        lines.append('cache_misses_total{{cache="{}"}} {}'.format(name, _caches[name].misses))
+    return '\n'.join(lines) + '\n'
+
+
+def _metrics_view():
+    return flask.Response(render(), mimetype='text/plain; version=0.0.4')
+
+
+def _profile_view():
+    if _auth is not None and not _auth.is_authorized():
+        return _auth.login_request()
+    name = flask.request.args.get('callback')
+    if name:
+        try:
+            interval = float(flask.request.args.get('interval', PROFILE_INTERVAL))
+        except ValueError:
+            return flask.Response('interval must be a number of seconds\n', status=400,
+                                  mimetype='text/plain')
+        low, high = PROFILE_INTERVALS
+        interval = PROFILE_INTERVAL if math.isnan(interval) else min(max(interval, low), high)
+        _profile_armed[name] = interval
+        return flask.Response('armed {} every {}s\n'.format(name, interval), mimetype='text/plain')
+    stacks = _profile_result['stacks']
+    body = ''.join('{} {}\n'.format(stack, count) for stack, count in stacks.most_common())
+    return flask.Response(body, mimetype='text/plain')
+
+
+def instrument(app, auth=None):
+    ''' Time every callback registered on app from now on and add the /metrics routes '''
+    global _auth
+    _auth = auth
+    register = app.callback
+
+    def callback(*args, **kwargs):
+        decorate = register(*args, **kwargs)
+
+        def wrap(func):
+            return decorate(timed(func))
+        return wrap
+
+    app.callback = callback
+    app.server.after_request(_finish)
+    app.server.add_url_rule('/metrics', 'metrics', _metrics_view)
+    app.server.add_url_rule('/metrics/profile', 'metrics_profile', _profile_view)
+    return app
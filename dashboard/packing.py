@@ -0,0 +1,51 @@
+''' Compact figure payloads: trace arrays as base64 typed arrays
+
+pack_figure replaces the x and y arrays of every trace with
+
+    {'dtype': 'float32', 'bdata': <base64 little-endian bytes>}
+
+datetimes become int64 milliseconds since the epoch (dtype 'int64') and the
+matching axis is switched to type 'date'. That includes the object arrays of
+datetimes plotly makes of a DatetimeIndex or Series in a graph object. assets/packing.js decodes them
+back into typed arrays in a clientside callback, so the browser never parses
+a JSON number or a datetime string per sample.
+'''
+import base64
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+AXES = {'x': 'xaxis', 'y': 'yaxis'}
+
+
+def pack(values):
+    ''' Return an array as a base64 typed array, or unchanged if it is not numeric '''
+    a = np.asarray(values)
+    if a.dtype.kind == 'O' and len(a) and isinstance(a[0], (date, np.datetime64)):
+        a = pd.to_datetime(a).values
+    if a.dtype.kind == 'M':
+        a = a.astype('datetime64[ms]').astype('<i8')
+        dtype = 'int64'
+    elif a.dtype.kind in 'biuf':
+        a = a.astype('<f4')
+        dtype = 'float32'
+    else:
+        return values
+    return {'dtype': dtype, 'bdata': base64.b64encode(np.ascontiguousarray(a).tobytes()).decode()}
+
+
+def pack_figure(fig):
+    ''' Return a copy of a figure dict with its trace arrays packed '''
+    layout = dict(fig.get('layout', {}))
+    data = []
+    for trace in fig['data']:
+        trace = trace.to_plotly_json() if hasattr(trace, 'to_plotly_json') else dict(trace)
+        for key, axis in AXES.items():
+            if key not in trace:
+                continue
+            trace[key] = pack(trace[key])
+            if isinstance(trace[key], dict) and trace[key]['dtype'] == 'int64':
+                layout[axis] = dict(layout.get(axis, {}), type='date')
+        data.append(trace)
+    return {'data': data, 'layout': layout}
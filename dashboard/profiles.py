@@ -0,0 +1,58 @@
+''' Temperature profiles of many flights on one altitude grid
+
+Each flight's binned TINV profile is interpolated onto a fixed grid and
+cached per flight, so a comparison of n flights is a vstack of n cached rows
+and adding a flight only costs that flight. Statistics are computed over the
+resulting (flights, altitude) array with NaN where a flight did not reach.
+'''
+import warnings
+
+import numpy as np
+
+import tinv
+from flightcache import flight_cache, flight_path
+
+GRID_STEP = 5.0
+GRID_TOP = 1000.0
+
+GRID = np.arange(0, GRID_TOP + GRID_STEP, GRID_STEP)
+
+
+def grid_profile(filename):
+    ''' Return a flight's mean temperature at every GRID altitude, NaN outside its range '''
+    def loader(path):
+        profile = tinv.load_profile(filename)
+        if not len(profile.alt):
+            return np.full(len(GRID), np.nan)
+        return np.interp(GRID, profile.alt, profile.temp, left=np.nan, right=np.nan)
+
+    return flight_cache.get(flight_path(filename), loader,
+                            kind=('grid', GRID_STEP, GRID_TOP), sizeof=lambda a: a.nbytes)
+
+
+def profile_matrix(filenames):
+    ''' Return the (flights, altitude) array of the given flights' grid profiles '''
+    if not filenames:
+        return np.empty((0, len(GRID)))
+    return np.vstack([grid_profile(f) for f in filenames])
+
+
+def statistics(matrix, percentiles=(10, 90)):
+    ''' Return the mean and the percentile bands of a profile matrix per altitude '''
+    with warnings.catch_warnings():
+        # altitudes no flight reached are all NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = np.nanmean(matrix, axis=0)
+        bands = np.nanpercentile(matrix, percentiles, axis=0)
+    return mean, bands
+
+
+def anomaly(matrix, climatology):
+    ''' Return each profile's departure from the climatological mean profile '''
+    return matrix - climatology[np.newaxis, :]
+
+
+def reached(matrix):
+    ''' Return the number of grid altitudes up to the highest one any flight reached '''
+    valid = np.flatnonzero(np.isfinite(matrix).any(axis=0))
+    return valid[-1] + 1 if len(valid) else 0
@@ -0,0 +1,114 @@
+''' Sensor quality control for balloon samples
+
+A sample is kept when every channel passes three checks:
+
+    dropout  the reading is present (finite)
+    range    the reading lies within the sensor's physical RANGES
+    spike    a causal Hampel filter: the reading is within N_SIGMA scaled
+             MADs (at least the channel's FLOORS resolution) of the median
+             of the WINDOW raw readings before it
+
+The MAD is the rolling median, over the same window, of each reading's
+absolute deviation from the median before it. Both medians are pandas
+rolling medians, so a flight costs a couple of O(n log WINDOW) passes.
+
+The filter only looks backwards at raw readings, so a flight checked in one
+pass and the same flight checked as it is appended (StreamingQA, used by
+live telemetry) produce identical masks, as long as the appended rows come
+with the HISTORY readings before them.
+'''
+import numpy as np
+import pandas as pd
+
+from flightcache import flight_cache, flight_path, frame_nbytes, load_flight
+import flightstore
+
+WINDOW = 31
+# readings a continued series needs: a window of deviations, each of which
+# needs the window before it
+HISTORY = 2 * WINDOW
+MIN_PERIODS = 10
+N_SIGMA = 5.0
+MAD_SCALE = 1.4826
+# part of the stored clean view's name; bump it when the checks change
+VERSION = 1
+
+RANGES = {'temp': (-40.0, 60.0), 'press': (300.0, 1100.0), 'alt': (-50.0, 5000.0)}
+# the readings' resolution, so quantization steps are not spikes
+FLOORS = {'temp': 0.1, 'press': 1.0, 'alt': 1.0}
+
+
+def _before(series, window, func):
+    # the rolling statistic of the window values strictly before each one
+    return getattr(series.rolling(window, min_periods=1), func)().shift(1).values
+
+
+def hampel(x, history=None, window=WINDOW, n_sigma=N_SIGMA, floor=0.0, min_periods=MIN_PERIODS):
+    ''' Flag readings far from the median of the window readings before them
+
+    history holds the readings that preceded x, when x continues a series.
+    '''
+    x = np.asarray(x, dtype='float64')
+    before = np.empty(0) if history is None else np.asarray(history, dtype='float64')
+    series = pd.Series(np.concatenate([before[-2 * window:], x]))
+    median = _before(series, window, 'median')
+    mad = _before((series - median).abs(), window, 'median')
+    count = _before(series.notna().astype('float64'), window, 'sum')
+    skip = len(series) - len(x)
+    median, mad, count = median[skip:], mad[skip:], count[skip:]
+    # fmax, so a window without deviations yet still uses the floor
+    limit = n_sigma * np.fmax(MAD_SCALE * mad, floor)
+    with np.errstate(invalid='ignore'):
+        return (count >= min_periods) & (np.abs(x - median) > limit)
+
+
+def quality_mask(df, history=None):
+    ''' Return True for every row of a flight whose readings pass all checks '''
+    good = np.ones(len(df), dtype=bool)
+    for column, (low, high) in RANGES.items():
+        if column not in df.columns:
+            continue
+        x = df[column].values.astype('float64')
+        with np.errstate(invalid='ignore'):
+            good &= np.isfinite(x) & (x >= low) & (x <= high)
+        good &= ~hampel(x, None if history is None else history.get(column),
+                        floor=FLOORS[column])
+    return good
+
+
+class StreamingQA(object):
+    ''' Masks appended rows exactly as quality_mask would over the whole flight '''
+
+    def __init__(self, history=HISTORY):
+        self.size = history
+        self.history = {}
+
+    def update(self, df):
+        good = quality_mask(df, self.history)
+        for column in RANGES:
+            if column in df.columns:
+                tail = np.concatenate([self.history.get(column, np.empty(0)),
+                                       df[column].values.astype('float64')])
+                self.history[column] = tail[-self.size:]
+        return good
+
+
+def load_mask(filename):
+    ''' Return the cached quality mask of a flight in the balloon data directory '''
+    return flight_cache.get(flight_path(filename),
+                            lambda path: quality_mask(load_flight(filename)),
+                            kind='qa', sizeof=lambda mask: mask.nbytes)
+
+
+def load_clean(filename):
+    ''' Return the cached samples of a flight that passed quality control
+
+    They are memory-mapped from a view in the flight store, so the pages are
+    shared by every worker rather than copied into each.
+    '''
+    def loader(path):
+        return flightstore.load_view(path, 'clean{}'.format(VERSION),
+                                     lambda: load_flight(filename)[load_mask(filename)])
+
+    return flight_cache.get(flight_path(filename), loader,
+                            kind='clean', sizeof=frame_nbytes)
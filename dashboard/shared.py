@@ -0,0 +1,91 @@
+''' Datasets shared between gunicorn workers through named shared memory
+
+A dataset is written once as a directory of .npy blocks under /dev/shm (a
+RAM-backed tmpfs) and every worker memory-maps the same pages read-only, so
+adding workers does not add copies. Columns of one dtype are stored as a
+single (ncols, nrows) block, which pandas can wrap without copying; columns
+come back grouped by dtype.
+
+Balloon flights already live in memory-mapped store files (see flightstore);
+preload_flights() opens them in the gunicorn master when it runs with
+--preload, so workers inherit the mappings instead of opening their own.
+'''
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+shmway = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(),
+                      'pollucell')
+
+
+def _dataset_dir(name):
+    return os.path.join(shmway, name)
+
+
+def put_frame(name, df, version):
+    ''' Publish a DataFrame of numeric and datetime columns as a shared dataset '''
+    if not os.path.isdir(shmway):
+        os.makedirs(shmway)
+    tmp = tempfile.mkdtemp(prefix='.{}-'.format(name), dir=shmway)
+    groups = {}
+    for column in df.columns:
+        groups.setdefault(df[column].dtype.str, []).append(column)
+    meta = {'version': version, 'columns': list(df.columns), 'rows': len(df), 'blocks': []}
+    for i, (dtype, columns) in enumerate(sorted(groups.items())):
+        block = np.empty((len(columns), len(df)), dtype=dtype)
+        for j, column in enumerate(columns):
+            block[j] = df[column].values
+        np.save(os.path.join(tmp, 'block{}.npy'.format(i)), block)
+        meta['blocks'].append(columns)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    target = _dataset_dir(name)
+    if os.path.isdir(target):
+        shutil.rmtree(target, ignore_errors=True)
+    try:
+        os.rename(tmp, target)
+    except OSError:
+        # another worker published it first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def get_frame(name, version=None):
+    ''' Attach to a shared dataset as a read-only DataFrame, or return None if absent or stale '''
+    target = _dataset_dir(name)
+    try:
+        with open(os.path.join(target, 'meta.json')) as f:
+            meta = json.load(f)
+        if version is not None and meta['version'] != version:
+            return None
+        blocks = [np.load(os.path.join(target, 'block{}.npy'.format(i)), mmap_mode='r')
+                  for i in range(len(meta['blocks']))]
+    except (IOError, OSError, ValueError):
+        return None
+
+    df = pd.DataFrame(blocks[0].T, columns=meta['blocks'][0], copy=False)
+    for block, columns in zip(blocks[1:], meta['blocks'][1:]):
+        for j, column in enumerate(columns):
+            df[column] = block[j]
+    return df
+
+
+def load_frame(name, path, reader):
+    ''' Return the shared copy of a file read with reader(path), publishing it on first use '''
+    version = os.path.getmtime(path)
+    df = get_frame(name, version)
+    if df is None:
+        put_frame(name, reader(path), version)
+        df = get_frame(name, version)
+    return df
+
+
+def preload_flights(filenames):
+    ''' Open every flight's memory map in this process, ahead of forking workers '''
+    from flightcache import load_flight
+    for filename in filenames:
+        load_flight(filename)
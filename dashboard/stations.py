@@ -0,0 +1,154 @@
+''' Air4Thai station list with a grid index for nearest-station lookups
+
+Stations are bucketed into square lat/long cells. A k-nearest query walks
+rings of cells outward from the query cell and stops as soon as no unvisited
+ring can hold a closer station, so a query only touches the stations around
+it. Distances are great-circle kilometres.
+'''
+import math
+
+import numpy as np
+import pandas as pd
+
+stationway = '../sampledata/station_list.csv'
+
+EARTH_RADIUS = 6371.0088
+KM_PER_DEG = math.pi * EARTH_RADIUS / 180
+CELL_DEG = 0.05
+CHUNK = 4096
+
+
+def haversine(lat1, long1, lat2, long2):
+    ''' Great-circle distance in km between points given in degrees, broadcasting '''
+    lat1, long1, lat2, long2 = (np.radians(v) for v in (lat1, long1, lat2, long2))
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((long2 - long1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+class StationIndex(object):
+    ''' Grid index over station coordinates answering k-nearest and radius queries '''
+
+    def __init__(self, stations, cell_deg=CELL_DEG):
+        self.stations = stations.reset_index(drop=True)
+        self.lat = self.stations['lat'].values.astype('float64')
+        self.long = self.stations['long'].values.astype('float64')
+        self.cell_deg = cell_deg
+
+        i = np.floor(self.lat / cell_deg).astype('int64')
+        j = np.floor(self.long / cell_deg).astype('int64')
+        self.cells = {}
+        for row, key in enumerate(zip(i.tolist(), j.tolist())):
+            self.cells.setdefault(key, []).append(row)
+        self.cells = {key: np.array(rows) for key, rows in self.cells.items()}
+        self.bounds = (i.min(), i.max(), j.min(), j.max())
+
+        # a ring r cells away is at least this many km per ring, wherever the query is
+        max_lat = min(89.0, np.abs(self.lat).max() + cell_deg)
+        self.ring_km = cell_deg * KM_PER_DEG * math.cos(math.radians(max_lat))
+
+    def __len__(self):
+        return len(self.stations)
+
+    def _cell(self, lat, long):
+        return int(math.floor(lat / self.cell_deg)), int(math.floor(long / self.cell_deg))
+
+    def _ring(self, ci, cj, r):
+        if r == 0:
+            rows = self.cells.get((ci, cj))
+            return [] if rows is None else [rows]
+        found = []
+        for i in range(ci - r, ci + r + 1):
+            for j in (cj - r, cj + r):
+                rows = self.cells.get((i, j))
+                if rows is not None:
+                    found.append(rows)
+        for j in range(cj - r + 1, cj + r):
+            for i in (ci - r, ci + r):
+                rows = self.cells.get((i, j))
+                if rows is not None:
+                    found.append(rows)
+        return found
+
+    def _max_ring(self, ci, cj):
+        imin, imax, jmin, jmax = self.bounds
+        return max(abs(ci - imin), abs(ci - imax), abs(cj - jmin), abs(cj - jmax))
+
+    def nearest(self, lat, long, k=1):
+        ''' Return (rows, distances) of the k stations nearest to a point, closest first '''
+        k = min(k, len(self))
+        ci, cj = self._cell(lat, long)
+        max_ring = self._max_ring(ci, cj)
+        found = []
+        r = 0
+        while True:
+            found.extend(self._ring(ci, cj, r))
+            if found:
+                rows = np.concatenate(found)
+                if len(rows) >= k:
+                    dist = haversine(lat, long, self.lat[rows], self.long[rows])
+                    # stations in rings beyond r are at least r rings away
+                    if np.partition(dist, k - 1)[k - 1] <= r * self.ring_km or r >= max_ring:
+                        order = np.argsort(dist, kind='mergesort')[:k]
+                        return rows[order], dist[order]
+            if r >= max_ring:
+                return np.array([], dtype='int64'), np.array([])
+            r += 1
+
+    def within(self, lat, long, radius):
+        ''' Return (rows, distances) of every station within radius km, closest first '''
+        ci, cj = self._cell(lat, long)
+        rings = min(int(math.ceil(radius / self.ring_km)), self._max_ring(ci, cj))
+        found = []
+        for r in range(rings + 1):
+            found.extend(self._ring(ci, cj, r))
+        if not found:
+            return np.array([], dtype='int64'), np.array([])
+        rows = np.concatenate(found)
+        dist = haversine(lat, long, self.lat[rows], self.long[rows])
+        keep = dist <= radius
+        rows, dist = rows[keep], dist[keep]
+        order = np.argsort(dist, kind='mergesort')
+        return rows[order], dist[order]
+
+    def nearest_batch(self, lats, longs, k=1):
+        ''' Return (rows, distances) arrays of shape (n, k) for many points at once '''
+        lats = np.asarray(lats, dtype='float64')
+        longs = np.asarray(longs, dtype='float64')
+        k = min(k, len(self))
+        rows = np.empty((len(lats), k), dtype='int64')
+        dist = np.empty((len(lats), k))
+        for start in range(0, len(lats), CHUNK):
+            stop = start + CHUNK
+            d = haversine(lats[start:stop, None], longs[start:stop, None],
+                          self.lat[None, :], self.long[None, :])
+            part = np.argpartition(d, k - 1, axis=1)[:, :k]
+            dpart = np.take_along_axis(d, part, axis=1)
+            order = np.argsort(dpart, axis=1, kind='mergesort')
+            rows[start:stop] = np.take_along_axis(part, order, axis=1)
+            dist[start:stop] = np.take_along_axis(dpart, order, axis=1)
+        return rows, dist
+
+    def station(self, row):
+        ''' Return one station as a dict '''
+        return self.stations.iloc[int(row)].to_dict()
+
+
+_index = None
+
+
+def get_index():
+    ''' Return the station index, loading the station list on first use '''
+    global _index
+    if _index is None:
+        _index = StationIndex(pd.read_csv(stationway, dtype={'stationID': str}))
+    return _index
+
+
+def nearest_station(lat, long):
+    ''' Return the station nearest to a point as a dict with its distance in km '''
+    index = get_index()
+    rows, dist = index.nearest(lat, long, k=1)
+    station = index.station(rows[0])
+    station['distance'] = float(dist[0])
+    return station
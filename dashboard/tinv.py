@@ -0,0 +1,119 @@
+''' Temperature inversion (TINV) detection on binned altitude profiles
+
+Samples are binned by altitude with a single bincount pass, so detection is
+linear in the number of samples. A bin labelled k holds the samples with
+k * bin_size < alt <= (k + 1) * bin_size, matching pd.cut over
+np.arange(0, alt.max() + 1, bin_size) with labels=False.
+
+The inverse rate of change between a bin and the bin lag places below it is
+
+    iroc = -(temp[i] - temp[i - lag]) / (alt[i] - alt[i - lag])
+
+and every run of bins with iroc < threshold is reported as one layer.
+'''
+from collections import namedtuple
+
+import numpy as np
+
+from flightcache import flight_cache, flight_path
+import qa
+
+BIN_SIZE = 1.0
+LAG = 5
+THRESHOLD = -0.1
+
+Profile = namedtuple('Profile', ['bins', 'alt', 'temp', 'iroc', 'layers'])
+Layer = namedtuple('Layer', ['start', 'end', 'peak', 'strength'])
+
+
+def bin_sums(alt, temp, bin_size=BIN_SIZE, minlength=0):
+    ''' Return per-bin sample counts and alt/temp sums indexed by bin label '''
+    alt = np.asarray(alt, dtype='float64')
+    temp = np.asarray(temp, dtype='float64')
+    valid = (alt > 0) & np.isfinite(alt) & np.isfinite(temp)
+    alt = alt[valid]
+    temp = temp[valid]
+    labels = np.ceil(alt / bin_size).astype('int64') - 1
+    counts = np.bincount(labels, minlength=minlength)
+    alt_sums = np.bincount(labels, weights=alt, minlength=minlength)
+    temp_sums = np.bincount(labels, weights=temp, minlength=minlength)
+    return counts, alt_sums, temp_sums
+
+
+def profile_from_sums(counts, alt_sums, temp_sums, bin_size=BIN_SIZE,
+                      lag=LAG, threshold=THRESHOLD):
+    ''' Build the mean profile and its inversion layers from per-bin sums '''
+    labels = np.flatnonzero(counts)
+    n = counts[labels]
+    alt = alt_sums[labels] / n
+    temp = temp_sums[labels] / n
+    bins = labels * bin_size
+
+    iroc = np.full(len(labels), np.nan)
+    if len(labels) > lag:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            iroc[lag:] = -(temp[lag:] - temp[:-lag]) / (alt[lag:] - alt[:-lag])
+
+    layers = []
+    inside = np.zeros(len(labels) + 2, dtype='int8')
+    inside[1:-1] = iroc < threshold
+    edges = np.diff(inside)
+    for first, last in zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1):
+        peak = first + np.argmin(iroc[first:last + 1])
+        layers.append(Layer(start=bins[first - lag], end=bins[last],
+                            peak=bins[peak], strength=-iroc[peak]))
+
+    return Profile(bins=bins, alt=alt, temp=temp, iroc=iroc, layers=layers)
+
+
+def detect(alt, temp, bin_size=BIN_SIZE, lag=LAG, threshold=THRESHOLD):
+    ''' Bin an altitude/temperature series and detect every inversion layer '''
+    counts, alt_sums, temp_sums = bin_sums(alt, temp, bin_size)
+    return profile_from_sums(counts, alt_sums, temp_sums, bin_size, lag, threshold)
+
+
+class BinAccumulator(object):
+    ''' Running per-bin sums that grow as samples are appended '''
+
+    def __init__(self, bin_size=BIN_SIZE):
+        self.bin_size = bin_size
+        self.counts = np.zeros(0, dtype='int64')
+        self.alt_sums = np.zeros(0)
+        self.temp_sums = np.zeros(0)
+
+    def add(self, alt, temp):
+        counts, alt_sums, temp_sums = bin_sums(alt, temp, self.bin_size)
+        if len(counts) > len(self.counts):
+            size = max(len(counts), 2 * len(self.counts))
+            self.counts = np.pad(self.counts, (0, size - len(self.counts)), 'constant')
+            self.alt_sums = np.pad(self.alt_sums, (0, size - len(self.alt_sums)), 'constant')
+            self.temp_sums = np.pad(self.temp_sums, (0, size - len(self.temp_sums)), 'constant')
+        self.counts[:len(counts)] += counts
+        self.alt_sums[:len(counts)] += alt_sums
+        self.temp_sums[:len(counts)] += temp_sums
+
+    def profile(self, lag=LAG, threshold=THRESHOLD):
+        return profile_from_sums(self.counts, self.alt_sums, self.temp_sums,
+                                 self.bin_size, lag, threshold)
+
+
+def strongest(profile):
+    ''' Return the layer with the steepest inversion, or None '''
+    if not profile.layers:
+        return None
+    return max(profile.layers, key=lambda layer: layer.strength)
+
+
+def _profile_nbytes(profile):
+    return sum(getattr(profile, field).nbytes for field in ('bins', 'alt', 'temp', 'iroc'))
+
+
+def load_profile(filename, bin_size=BIN_SIZE, lag=LAG, threshold=THRESHOLD):
+    ''' Return the cached TINV profile of a flight's quality-controlled samples '''
+    def loader(path):
+        df = qa.load_clean(filename)
+        return detect(df['alt'].values, df['temp'].values, bin_size, lag, threshold)
+
+    return flight_cache.get(flight_path(filename), loader,
+                            kind=('tinv', bin_size, lag, threshold),
+                            sizeof=_profile_nbytes)
@@ -0,0 +1,90 @@
+''' Run TINV detection over every balloon flight in a directory tree
+
+Flights are spread over a process pool and handed out in chunks, and the
+strongest inversion of each flight is written as one row of a summary CSV.
+Samples that fail quality control (qa) are left out of the detection.
+
+Usage: python tinv_batch.py ../data/balloon -o tinv_summary.csv [--threshold -0.1]
+'''
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import qa
+import tinv
+
+COLUMNS = ['file', 'start', 'end', 'samples', 'flagged', 'layers', 'tinv_alt', 'tinv_start',
+           'tinv_end', 'strength', 'tinv_time', 'error']
+
+
+def find_flights(root):
+    ''' Return every CSV below root, sorted '''
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        found.extend(os.path.join(dirpath, f) for f in sorted(filenames) if f.endswith('.csv'))
+    return found
+
+
+def analyze(path, bin_size=tinv.BIN_SIZE, lag=tinv.LAG, threshold=tinv.THRESHOLD):
+    ''' Return the summary row of one flight '''
+    row = dict.fromkeys(COLUMNS)
+    row['file'] = path
+    try:
+        df = pd.read_csv(path, usecols=lambda c: c in ('datetime', 'temp', 'press', 'alt'),
+                         parse_dates=['datetime'])
+        good = qa.quality_mask(df)
+        df = df[good].reset_index(drop=True)
+        profile = tinv.detect(df['alt'].values, df['temp'].values, bin_size, lag, threshold)
+    except Exception as e:
+        row['error'] = repr(e)
+        return row
+
+    row.update(start=df['datetime'].min(), end=df['datetime'].max(),
+               samples=len(good), flagged=int((~good).sum()), layers=len(profile.layers))
+    layer = tinv.strongest(profile)
+    if layer is not None:
+        # when the balloon first reached the peak bin of the layer
+        reached = np.flatnonzero((df['alt'].values > layer.peak)
+                                 & (df['alt'].values <= layer.peak + bin_size))
+        row.update(tinv_alt=layer.peak, tinv_start=layer.start, tinv_end=layer.end,
+                   strength=layer.strength,
+                   tinv_time=df['datetime'].iloc[reached[0]] if len(reached) else None)
+    return row
+
+
+def _analyze(args):
+    return analyze(*args)
+
+
+def run(paths, workers=None, chunksize=None, **params):
+    ''' Analyze every flight on a process pool and return the summary table '''
+    workers = workers or os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, len(paths) // (workers * 4))
+    jobs = [(path, params.get('bin_size', tinv.BIN_SIZE), params.get('lag', tinv.LAG),
+             params.get('threshold', tinv.THRESHOLD)) for path in paths]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        rows = list(pool.map(_analyze, jobs, chunksize=chunksize))
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batch temperature inversion analysis')
+    parser.add_argument('root', nargs='?', default='../data/balloon/')
+    parser.add_argument('-o', '--output', default='tinv_summary.csv')
+    parser.add_argument('-j', '--workers', type=int, default=None)
+    parser.add_argument('--chunksize', type=int, default=None)
+    parser.add_argument('--bin-size', type=float, default=tinv.BIN_SIZE)
+    parser.add_argument('--lag', type=int, default=tinv.LAG)
+    parser.add_argument('--threshold', type=float, default=tinv.THRESHOLD)
+    args = parser.parse_args()
+
+    summary = run(find_flights(args.root), args.workers, args.chunksize,
+                  bin_size=args.bin_size, lag=args.lag, threshold=args.threshold)
+    summary.to_csv(args.output, index=False)
+    print('{} flights, {} with an inversion -> {}'.format(
+        len(summary), summary['tinv_alt'].notnull().sum(), args.output))
@@ -0,0 +1,345 @@
+''' Local warehouse of Air4Thai hourly history for every station
+
+Values are kept as one float32 array per param and month, shaped (stations,
+hours in the month), in warehouseway/<param>/<YYYY-MM>.npy, with NaN for
+hours the API had no value. manifest.json holds the station order (the array
+rows) and what has been synced: per param and station, the first and last
+day of a continuous sync, and any day windows synced on their own.
+
+sync() backfills every station from BACKFILL_START and afterwards only
+refetches from each station's last synced day; run it where the warehouse
+is on persistent storage (python warehouse.py, with --every to keep
+syncing). sync_windows() fetches only given day windows for every station.
+Reads are range scans over memory-mapped month partitions, so any window
+across all stations is a slice of one or two arrays.
+
+The web app syncs only the windows its flights need: watch(server, windows)
+starts a thread in each worker on its first request, and an exclusive lock
+file lets one of them at a time fetch the windows not synced yet, every
+SYNC_INTERVAL seconds. A dyno's filesystem is ephemeral, so this keeps a
+restart's backfill to a few days per flight.
+'''
+import argparse
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import air4thai
+from metrics import phase
+from stations import stationway
+
+warehouseway = '../data/warehouse/'
+BACKFILL_START = '2019-01-01'
+CHUNK_DAYS = 31
+HOUR = np.timedelta64(1, 'h')
+
+logger = logging.getLogger(__name__)
+# None disables the in-app sync
+SYNC_INTERVAL = 3600
+
+_syncer_pid = None
+_syncer_lock = threading.Lock()
+
+
+def _save_json(path, obj):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp, path)
+
+
+def load_manifest():
+    try:
+        with open(os.path.join(warehouseway, 'manifest.json')) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = {'stations': []}
+    for key in ('since', 'synced', 'windows'):
+        manifest.setdefault(key, {})
+    return manifest
+
+
+def partition(param, month):
+    return os.path.join(warehouseway, param, '{}.npy'.format(month))
+
+
+def _month_bounds(month):
+    start = month.astype('datetime64[h]')
+    return start, (month + 1).astype('datetime64[h]')
+
+
+def _fetch(station_id, param, start, end):
+    ''' Return (times, values) of one station over whole days start..end '''
+    params = air4thai.history_params(station_id, param, start.strftime(air4thai.DATE_FORMAT),
+                                     end.strftime(air4thai.DATE_FORMAT))
+    source = air4thai.request_history(params)
+    data = source['stations'][0]['data'] if source.get('stations') else []
+    if not data:
+        return np.empty(0, dtype='datetime64[h]'), np.empty(0, dtype='float32')
+    df = pd.DataFrame(data)
+    times = pd.to_datetime(df.iloc[:, 0]).values.astype('datetime64[h]')
+    values = pd.to_numeric(df.iloc[:, 1], errors='coerce').values.astype('float32')
+    return times, values
+
+
+def _write(param, rows, times, values, nstations):
+    ''' Scatter (row, hour, value) triples into their month partitions '''
+    months = times.astype('datetime64[M]')
+    for month in np.unique(months):
+        sel = months == month
+        start, end = _month_bounds(month)
+        path = partition(param, month)
+        try:
+            block = np.load(path)
+        except IOError:
+            block = np.full((0, (end - start) // HOUR), np.nan, dtype='float32')
+        if block.shape[0] < nstations:
+            # stations added to the list since this month was written
+            pad = np.full((nstations - block.shape[0], block.shape[1]), np.nan, dtype='float32')
+            block = np.vstack([block, pad])
+        block[rows[sel], (times[sel] - start) // HOUR] = values[sel]
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, block)
+        os.replace(tmp, path)
+
+
+def _sync_requests(manifest, param, requests, pool):
+    ''' Fetch (row, station id, start, end) day ranges of a param into the warehouse
+
+    Returns the station ids that had a request fail.
+    '''
+    jobs = []
+    for row, station_id, start, end in requests:
+        for chunk in pd.date_range(start, end, freq='{}D'.format(CHUNK_DAYS)):
+            chunk_end = min(chunk + pd.Timedelta(days=CHUNK_DAYS - 1), end)
+            jobs.append((row, station_id, pool.submit(_fetch, station_id, param, chunk, chunk_end)))
+
+    failed = set()
+    rows, times, values = [], [], []
+    for row, station_id, future in jobs:
+        try:
+            t, v = future.result()
+        except Exception as e:
+            logger.warning('%s %s: %s', station_id, param, e)
+            failed.add(station_id)
+            continue
+        rows.append(np.full(len(t), row))
+        times.append(t)
+        values.append(v)
+    if times:
+        _write(param, np.concatenate(rows), np.concatenate(times),
+               np.concatenate(values), len(manifest['stations']))
+    return failed
+
+
+def _stations(manifest):
+    listed = list(pd.read_csv(stationway, dtype={'stationID': str})['stationID'])
+    manifest['stations'] = manifest['stations'] + [s for s in listed
+                                                   if s not in manifest['stations']]
+    return manifest['stations']
+
+
+def _save_manifest(manifest):
+    if not os.path.isdir(warehouseway):
+        os.makedirs(warehouseway)
+    _save_json(os.path.join(warehouseway, 'manifest.json'), manifest)
+
+
+def sync(params=air4thai.PARAMS, since=BACKFILL_START, workers=air4thai.MAX_WORKERS):
+    ''' Fetch every station's history up to today, from where the last sync stopped '''
+    manifest = load_manifest()
+    stations = _stations(manifest)
+    end = pd.Timestamp(air4thai.today())
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for param in params:
+            synced = manifest['synced'].setdefault(param, {})
+            first = manifest['since'].setdefault(param, {})
+            # the last synced day is fetched again, it may have been partial
+            requests = [(row, station_id, pd.Timestamp(synced.get(station_id, since)), end)
+                        for row, station_id in enumerate(stations)]
+            failed = _sync_requests(manifest, param, requests, pool)
+            for row, station_id, start, _ in requests:
+                if station_id not in failed:
+                    # a station synced before 'since' was recorded covers at least this run
+                    first.setdefault(station_id, str(start.date()))
+                    synced[station_id] = str(end.date())
+            _save_manifest(manifest)
+    return manifest
+
+
+def sync_windows(windows, params=air4thai.PARAMS, workers=air4thai.MAX_WORKERS):
+    ''' Fetch every station's history over the (sdate, edate) windows not synced yet
+
+    Dates are in air4thai.DATE_FORMAT, as the dashboard asks for them. A window
+    reaching today is recorded as synced through today and fetched again by
+    the next call.
+    '''
+    manifest = load_manifest()
+    stations = _stations(manifest)
+    today = pd.Timestamp(air4thai.today())
+    windows = sorted(set((pd.Timestamp(datetime.strptime(s, air4thai.DATE_FORMAT)),
+                          min(pd.Timestamp(datetime.strptime(e, air4thai.DATE_FORMAT)), today))
+                         for s, e in windows))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for param in params:
+            synced = manifest['windows'].setdefault(param, {})
+            requests = [(row, station_id, start, end)
+                        for start, end in windows if start <= end
+                        for row, station_id in enumerate(stations)
+                        if not _covers(manifest, station_id, param, start, end)
+                        or end >= today]
+            if not requests:
+                continue
+            failed = _sync_requests(manifest, param, requests, pool)
+            for row, station_id, start, end in requests:
+                if station_id not in failed:
+                    ranges = synced.setdefault(station_id, [])
+                    window = [str(start.date()), str(end.date())]
+                    # a window reaching today only grows at its end
+                    ranges[:] = [r for r in ranges if r[0] != window[0]] + [window]
+            _save_manifest(manifest)
+    return manifest
+
+
+def read_range(param, start, end, stations=None):
+    ''' Return (hours, station ids, values) for every hour from start to end inclusive
+
+    values is a float32 array shaped (len(station ids), len(hours)).
+    '''
+    manifest = load_manifest()
+    ids = manifest['stations'] if stations is None else list(stations)
+    index = {s: i for i, s in enumerate(manifest['stations'])}
+    rows = np.array([index.get(s, -1) for s in ids], dtype='int64')
+    start = np.datetime64(pd.Timestamp(start), 'h')
+    end = np.datetime64(pd.Timestamp(end), 'h')
+    hours = np.arange(start, end + HOUR, HOUR)
+    out = np.full((len(ids), len(hours)), np.nan, dtype='float32')
+
+    for month in np.arange(start.astype('datetime64[M]'), end.astype('datetime64[M]') + 1):
+        try:
+            block = np.load(partition(param, month), mmap_mode='r')
+        except IOError:
+            continue
+        m0, m1 = _month_bounds(month)
+        lo, hi = max(start, m0), min(end + HOUR, m1)
+        present = (rows >= 0) & (rows < block.shape[0])
+        out[present, (lo - start) // HOUR:(hi - start) // HOUR] = \
+            block[rows[present], (lo - m0) // HOUR:(hi - m0) // HOUR]
+    return hours, ids, out
+
+
+def _covers(manifest, station_id, param, sdate, edate):
+    sdate, edate = pd.Timestamp(sdate), pd.Timestamp(edate)
+    first = manifest['since'].get(param, {}).get(station_id)
+    synced = manifest['synced'].get(param, {}).get(station_id)
+    if first is not None and synced is not None and \
+            pd.Timestamp(first) <= sdate and pd.Timestamp(synced) >= edate:
+        return True
+    return any(pd.Timestamp(lo) <= sdate and pd.Timestamp(hi) >= edate
+               for lo, hi in manifest['windows'].get(param, {}).get(station_id, []))
+
+
+def covers(station_id, param, sdate, edate):
+    ''' Whether the warehouse has synced a station's param from sdate through edate '''
+    return _covers(load_manifest(), station_id, param, sdate, edate)
+
+
+def prefetch(station_id, params, sdate, edate):
+    ''' Start fetching from the API only the params the warehouse has not synced '''
+    start = datetime.strptime(sdate, air4thai.DATE_FORMAT)
+    end = datetime.strptime(edate, air4thai.DATE_FORMAT)
+    missing = [p for p in params if not covers(station_id, p, start, end)]
+    return air4thai.prefetch(station_id, missing, sdate, edate)
+
+
+def history(station_id, param, sdate, edate, stime='00', etime='24', type='hr'):
+    ''' Return a station's history like air4thai.fetch_history, from the warehouse when synced '''
+    start = datetime.strptime(sdate, air4thai.DATE_FORMAT)
+    end = datetime.strptime(edate, air4thai.DATE_FORMAT)
+    if type != 'hr' or (stime, etime) != ('00', '24') or not covers(station_id, param, start, end):
+        return air4thai.fetch_history(station_id, param, sdate, edate, stime, etime, type)
+    with phase('load'):
+        hours, _, values = read_range(param, start, end + pd.Timedelta(hours=23), [station_id])
+    keep = np.isfinite(values[0])
+    return pd.DataFrame({'datetime': hours[keep].astype('datetime64[ns]'),
+                         'value': values[0][keep]}, columns=['datetime', 'value'])
+
+
+def _sync_once(windows):
+    ''' Sync windows() unless another process is syncing or has synced within SYNC_INTERVAL '''
+    if not os.path.isdir(warehouseway):
+        os.makedirs(warehouseway)
+    with open(os.path.join(warehouseway, 'sync.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            return
+        try:
+            age = time.time() - os.path.getmtime(os.path.join(warehouseway, 'manifest.json'))
+        except OSError:
+            age = None
+        if age is None or age >= SYNC_INTERVAL:
+            sync_windows(windows())
+
+
+def _watch(windows):
+    while SYNC_INTERVAL is not None:
+        try:
+            _sync_once(windows)
+        except Exception:
+            # windows that failed are fetched again on the next run
+            logger.exception('warehouse sync failed')
+        time.sleep(SYNC_INTERVAL)
+
+
+def start_syncer(windows):
+    ''' Start this process's background sync thread, once per process '''
+    global _syncer_pid
+    if _syncer_pid == os.getpid() or SYNC_INTERVAL is None:
+        return
+    with _syncer_lock:
+        if _syncer_pid == os.getpid():
+            return
+        _syncer_pid = os.getpid()
+    thread = threading.Thread(target=_watch, args=(windows,), name='warehouse-sync')
+    thread.daemon = True
+    thread.start()
+
+
+def watch(server, windows):
+    ''' Keep the windows() the app needs synced from each process serving server
+
+    The thread starts on a process's first request.
+    '''
+    server.before_request(lambda: start_syncer(windows))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sync the local Air4Thai history warehouse')
+    parser.add_argument('--params', nargs='+', default=air4thai.PARAMS)
+    parser.add_argument('--since', default=BACKFILL_START,
+                        help='first day to backfill for stations never synced')
+    parser.add_argument('-j', '--workers', type=int, default=air4thai.MAX_WORKERS)
+    parser.add_argument('--every', type=float, default=None,
+                        help='keep syncing, sleeping this many seconds between runs')
+    args = parser.parse_args()
+
+    while True:
+        sync(args.params, args.since, args.workers)
+        if args.every is None:
+            break
+        time.sleep(args.every)
@@ -0,0 +1,86 @@
+''' Lagged and rolling correlation between signal strength and pollutant series
+
+Both functions take 1-D series or 2-D (cells, time) arrays of regularly
+spaced samples and skip missing values (NaN) pairwise.
+
+lagged_xcorr computes the Pearson correlation of x[t] and y[t + lag] for
+every lag at once. Each of the six sums Pearson needs is a cross-correlation
+of masked series, and all of them are computed with FFTs, so the cost is
+O(n log n) per cell rather than O(n * lags).
+
+rolling_corr computes the Pearson correlation over a trailing window from
+cumulative sums in O(n) per cell, whatever the window length.
+'''
+import numpy as np
+
+
+def _prepare(x, y):
+    x = np.atleast_2d(np.asarray(x, dtype='float64'))
+    y = np.atleast_2d(np.asarray(y, dtype='float64'))
+    x, y = np.broadcast_arrays(x, y)
+    mx = np.isfinite(x)
+    my = np.isfinite(y)
+    # demean per cell so the sums below stay well conditioned
+    x = np.where(mx, x - np.nanmean(np.where(mx, x, np.nan), axis=-1, keepdims=True), 0.0)
+    y = np.where(my, y - np.nanmean(np.where(my, y, np.nan), axis=-1, keepdims=True), 0.0)
+    return x, y, mx.astype('float64'), my.astype('float64')
+
+
+def _pearson(n, sx, sy, sxx, syy, sxy, min_periods):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = sxy - sx * sy / n
+        var = (sxx - sx * sx / n) * (syy - sy * sy / n)
+        r = cov / np.sqrt(var)
+    r[(n < min_periods) | ~(var > 0)] = np.nan
+    return np.clip(r, -1, 1)
+
+
+def lagged_xcorr(x, y, max_lag, min_periods=3):
+    ''' Return (lags, r) with r[..., i] the correlation of x[t] and y[t + lags[i]] '''
+    squeeze = np.ndim(x) == 1 and np.ndim(y) == 1
+    x, y, mx, my = _prepare(x, y)
+    n = x.shape[-1]
+    max_lag = min(max_lag, n - 1)
+    size = 1 << int(np.ceil(np.log2(2 * n - 1)))
+
+    def spectrum(a):
+        return np.fft.rfft(a, size, axis=-1)
+
+    def correlate(fa, fb):
+        # sum over t of a[t] * b[t + lag], for lags -max_lag..max_lag
+        full = np.fft.irfft(np.conj(fa) * fb, size, axis=-1)
+        return np.concatenate([full[..., size - max_lag:], full[..., :max_lag + 1]], axis=-1)
+
+    fx, fy = spectrum(x), spectrum(y)
+    fmx, fmy = spectrum(mx), spectrum(my)
+    fxx, fyy = spectrum(x * x), spectrum(y * y)
+    count = np.round(correlate(fmx, fmy))
+    r = _pearson(count, correlate(fx, fmy), correlate(fmx, fy),
+                 correlate(fxx, fmy), correlate(fmx, fyy), correlate(fx, fy), min_periods)
+    lags = np.arange(-max_lag, max_lag + 1)
+    return lags, r[0] if squeeze else r
+
+
+def best_lag(lags, r):
+    ''' Return the lag with the strongest (absolute) correlation and its r, per cell '''
+    r = np.asarray(r)
+    i = np.nanargmax(np.abs(r), axis=-1)
+    return lags[i], np.take_along_axis(r, np.expand_dims(i, -1), axis=-1)[..., 0]
+
+
+def rolling_corr(x, y, window, min_periods=None):
+    ''' Return the correlation of x and y over a trailing window ending at each sample '''
+    squeeze = np.ndim(x) == 1 and np.ndim(y) == 1
+    x, y, mx, my = _prepare(x, y)
+    m = mx * my
+    x, y = x * m, y * m
+
+    def windowed(a):
+        c = np.cumsum(a, axis=-1)
+        c[..., window:] = c[..., window:] - c[..., :-window].copy()
+        return c
+
+    min_periods = window if min_periods is None else min_periods
+    r = _pearson(windowed(m), windowed(x), windowed(y), windowed(x * x),
+                 windowed(y * y), windowed(x * y), min_periods)
+    return r[0] if squeeze else r
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the dashboard modules import each other by name, as when run from dashboard/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'dashboard'))
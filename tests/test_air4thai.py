@@ -0,0 +1,99 @@
+''' The Air4Thai history cache, against a local stub of the API '''
+import json
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+import air4thai
+
+SOURCE = {'stations': [{'data': [['2019-03-01 00:00:00', 42.0]]}]}
+
+
+class Stub(BaseHTTPRequestHandler):
+    requests = 0
+
+    def do_GET(self):
+        Stub.requests += 1
+        body = json.dumps(SOURCE).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Clock(object):
+    ''' Stands in for the time module, so expiry can be tested without waiting '''
+
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    server = HTTPServer(('127.0.0.1', 0), Stub)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    Stub.requests = 0
+    monkeypatch.setattr(air4thai, 'url', 'http://127.0.0.1:{}/data.php'.format(server.server_port))
+    yield Stub
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(air4thai, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def cache(monkeypatch, tmp_path):
+    cache = air4thai.HistoryCache(str(tmp_path))
+    monkeypatch.setattr(air4thai, 'cache', cache)
+    return cache
+
+
+def day(offset=0):
+    return (air4thai.today() + timedelta(days=offset)).strftime(air4thai.DATE_FORMAT)
+
+
+def test_hit_does_not_call_the_api(stub, clock, cache):
+    assert air4thai.get_history('50t', 'PM25', day(-3), day(-2)) == SOURCE
+    assert air4thai.get_history('50t', 'PM25', day(-3), day(-2)) == SOURCE
+    assert stub.requests == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_other_params_are_separate_entries(stub, clock, cache):
+    air4thai.get_history('50t', 'PM25', day(-3), day(-2))
+    air4thai.get_history('50t', 'PM10', day(-3), day(-2))
+    assert stub.requests == 2
+
+
+def test_past_range_never_expires(stub, clock, cache):
+    air4thai.get_history('50t', 'PM25', day(-3), day(-1))
+    clock.now += 365 * 24 * 3600
+    air4thai.get_history('50t', 'PM25', day(-3), day(-1))
+    assert stub.requests == 1
+
+
+def test_range_covering_today_expires_after_ttl(stub, clock, cache):
+    air4thai.get_history('50t', 'PM25', day(-1), day(0))
+    clock.now += air4thai.TODAY_TTL - 1
+    air4thai.get_history('50t', 'PM25', day(-1), day(0))
+    assert stub.requests == 1
+    clock.now += 2
+    air4thai.get_history('50t', 'PM25', day(-1), day(0))
+    assert stub.requests == 2
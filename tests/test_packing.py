@@ -0,0 +1,46 @@
+''' Figure packing, decoded the way assets/packing.js does it '''
+import base64
+
+import numpy as np
+import pandas as pd
+import plotly.graph_objs as go
+
+import downsample
+import packing
+
+TIMES = pd.date_range('2019-05-13 08:00', periods=4, freq='250ms')
+
+
+def decode(packed):
+    dtype = {'float32': '<f4', 'int64': '<i8'}[packed['dtype']]
+    return np.frombuffer(base64.b64decode(packed['bdata']), dtype=dtype)
+
+
+def test_datetime64_x_is_packed_as_epoch_ms_on_a_date_axis():
+    fig = packing.pack_figure({'data': [{'x': TIMES.values, 'y': [1.0, 2.0, 3.0, 4.0]}],
+                               'layout': {'xaxis': {'title': 'Time'}}})
+    x = fig['data'][0]['x']
+    assert x['dtype'] == 'int64'
+    assert list(decode(x)) == list(TIMES.values.astype('datetime64[ms]').astype('int64'))
+    assert fig['layout']['xaxis'] == {'title': 'Time', 'type': 'date'}
+
+
+def test_graph_object_with_datetimes_is_packed_as_dates():
+    x, y = downsample.downsample(TIMES.values, np.arange(4.0))
+    fig = packing.pack_figure({'data': [go.Scatter(x=x, y=y)], 'layout': {}})
+    assert fig['data'][0]['x']['dtype'] == 'int64'
+    assert list(decode(fig['data'][0]['x'])) == \
+        list(TIMES.values.astype('datetime64[ms]').astype('int64'))
+    assert fig['layout']['xaxis']['type'] == 'date'
+
+
+def test_numbers_are_packed_as_float32_and_leave_the_axis_alone():
+    fig = packing.pack_figure({'data': [go.Scatter(x=[0, 1, 2], y=[0.5, 1.5, 2.5])],
+                               'layout': {}})
+    assert fig['data'][0]['y']['dtype'] == 'float32'
+    assert list(decode(fig['data'][0]['y'])) == [0.5, 1.5, 2.5]
+    assert 'xaxis' not in fig['layout']
+
+
+def test_text_is_left_unpacked():
+    assert packing.pack(['a', 'b']) == ['a', 'b']